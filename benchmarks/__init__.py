@@ -0,0 +1,10 @@
+"""Benchmarks for xmltrampshow.
+
+Run the suite from the repository root:
+
+    python -m benchmarks --output results.json
+
+and compare the JSON of two commits with
+
+    python -m benchmarks --compare old.json new.json
+"""
@@ -0,0 +1,160 @@
+"""Run the benchmark suite and write the results as JSON."""
+
+import argparse, io, json, os, platform, subprocess, sys, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from xmltrampshow.xmltrampshow import parse, parse_columns, StackShow
+from benchmarks.generate import document, siblings
+
+
+def timed(fn, repeat, setup=None):
+    """Return the best of repeat runs of fn() in seconds."""
+    best = None
+    for _ in range(repeat):
+        arg = setup() if setup else None
+        start = time.perf_counter()
+        fn(arg) if setup else fn()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def cases(quick):
+    shapes = [
+        dict(depth=3, fanout=10, text=16, attributes=2, namespaces=0.0),
+        dict(depth=3, fanout=10, text=16, attributes=2, namespaces=0.5),
+        dict(depth=1, fanout=2000, text=64, attributes=4, namespaces=0.0),
+        dict(depth=200, fanout=1, text=8, attributes=1, namespaces=0.0),
+    ]
+    if not quick:
+        shapes += [
+            dict(depth=4, fanout=12, text=32, attributes=3, namespaces=0.2),
+            dict(depth=1, fanout=20000, text=16, attributes=1, namespaces=0.0),
+            dict(depth=0, fanout=0, text=1 << 20, attributes=0, namespaces=0.0),
+        ]
+    return shapes
+
+
+def run(quick=False):
+    repeat = 3 if quick else 5
+    results = []
+
+    def record(name, params, seconds, ops=1):
+        results.append({'name': name, 'params': params, 'seconds': seconds,
+                         'per_op': seconds / ops, 'ops': ops})
+
+    for shape in cases(quick):
+        text = document(**shape)
+        params = dict(shape, size=len(text))
+        record('parse', params, timed(lambda: parse(text, show=None), repeat))
+        record('parse-expat', params, timed(lambda: parse(text, show=None, backend='expat'), repeat))
+        record('parse-columns', params, timed(lambda: parse_columns(text), repeat))
+        root = parse(text, show=None)
+        record('repr', params, timed(lambda: root.__repr__(1), repeat))
+        record('str', params, timed(lambda _: str(root), repeat,
+                                    setup=lambda: root._changed()))
+        record('getMaxLevel', params, timed(lambda _: root.getMaxLevel(), repeat,
+                                            setup=lambda: root._changed()))
+        record('digest', params, timed(lambda _: root.digest(), repeat,
+                                       setup=lambda: root._changed()))
+
+        def edited():
+            # one changed attribute deep down, both trees already hashed
+            other = parse(text, show=None)
+            element = other
+            while [x for x in element._dir if not isinstance(x, str)]:
+                element = [x for x in element._dir if not isinstance(x, str)][-1]
+            element._attrs['changed'] = 'yes'
+            other._changed()
+            root.digest()
+            other.digest()
+            return other
+
+        record('diff', params, timed(lambda other: root.diff(other), repeat, setup=edited))
+
+    for count in ((100, 1000) if quick else (100, 1000, 10000)):
+        root = parse(siblings(count), show=None)
+        params = {'siblings': count}
+        lookups = 1000
+
+        def getattrs():
+            for _ in range(lookups):
+                root.last
+
+        def getitems():
+            for _ in range(lookups):
+                root['last']
+                root['last':]
+
+        record('getattr', params, timed(getattrs, repeat), lookups)
+        record('getitem', params, timed(getitems, repeat), 2 * lookups)
+        record('setitem', params, timed(lambda r: r.__setitem__('item1', 'y'), repeat,
+                                        setup=lambda: parse(siblings(count), show=None)))
+        record('delitem', params, timed(lambda r: r.__delitem__(slice('last', None)), repeat,
+                                        setup=lambda: parse(siblings(count), show=None)))
+
+    root = parse(document(depth=5, fanout=3), show=None)
+    stack = [root]
+    while len(stack) < 6:
+        stack.append([x for x in stack[-1]._dir if not isinstance(x, str)][0])
+    for columns, lines in ((80, 24), (200, 60)):
+        show = StackShow(0, out=io.StringIO(), size=(columns, lines))
+        frames = 200
+
+        def render():
+            for i in range(frames):
+                show.sprint(stack[:i % len(stack) + 1], 'Stack IN', stack[i % len(stack)])
+
+        record('render', {'columns': columns, 'lines': lines, 'depth': len(stack)},
+               timed(render, repeat), frames)
+    return results
+
+
+def revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(old, new):
+    with open(old) as fo:
+        old = json.load(fo)
+    with open(new) as fo:
+        new = json.load(fo)
+    before = dict((json.dumps([r['name'], r['params']], sort_keys=True), r) for r in old['results'])
+    print('{:<12} {:<64} {:>12} {:>12} {:>8}'.format('name', 'params', 'before', 'after', 'ratio'))
+    for r in new['results']:
+        key = json.dumps([r['name'], r['params']], sort_keys=True)
+        if key in before:
+            b = before[key]['per_op']
+            params = ' '.join('{}={}'.format(k, v) for k, v in sorted(r['params'].items()))
+            print('{:<12} {:<64} {:>12.6f} {:>12.6f} {:>8.2f}'.format(
+                r['name'], params, b, r['per_op'], r['per_op'] / b))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--quick', action='store_true', help='fewer and smaller cases')
+    parser.add_argument('--output', help='write the JSON here instead of stdout')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'),
+                        help='print per-case ratios between two result files')
+    args = parser.parse_args()
+    if args.compare:
+        compare(*args.compare)
+        return
+    report = {'revision': revision(), 'python': platform.python_version(),
+              'platform': platform.platform(), 'time': time.time(), 'results': run(args.quick)}
+    if args.output:
+        with open(args.output, 'w') as fo:
+            json.dump(report, fo, indent=1)
+    else:
+        json.dump(report, sys.stdout, indent=1)
+        print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,620 @@
+"""Behaviour checks for the entry points besides parse().
+
+Run from the repository root:  python -m benchmarks.checks
+Prints one line per check and exits with status 1 if any fails.
+
+expected.json holds the serializations and str() results of the original
+Element for a set of documents. Only rewrite it from the current code
+(--update-expected) for a change that is meant to alter those outputs.
+"""
+
+import asyncio, copy, gc, io, json, os, random, shutil, sys, tempfile, threading, traceback
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import xmltrampshow.xmltrampshow as xt
+from xmltrampshow.xmltrampshow import (BigText, ConnectionPool, Element, Instrument, TreeCache,
+                                       aparse, iterparse, lazyparse, parse, parse_columns, parse_many,
+                                       parse_url, parse_urls, replay)
+from benchmarks.generate import document
+from benchmarks.parity import SAMPLES, same
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+EXPECTED = os.path.join(HERE, 'expected.json')
+
+with open(os.path.join(HERE, '..', 'xmltrampshow', 'movies.xml'), 'rb') as fo:
+    MOVIES = fo.read()
+
+NAMESPACED = [
+    '<a xmlns="urn:q"><b xmlns="">t</b></a>',
+    '<a xmlns="urn:q" id="1" x="y"><b xmlns="" id="2"><c id="3">t</c></b><d/></a>',
+    '<a xmlns:p="urn:p" p:x="1" p:y="2"><p:b xmlns:p="urn:q" p:z="3"><p:c/></p:b></a>',
+    '<p:a xmlns:p="urn:p" xmlns="urn:d"><b/><p:c xmlns=""><d/></p:c></p:a>',
+]
+
+
+def check(problem, message):
+    if problem:
+        raise AssertionError('{}: {}'.format(message, problem))
+
+
+def elements(root):
+    """Return the elements of the tree in document order."""
+    out = []
+    stack = [root]
+    while stack:
+        x = stack.pop()
+        out.append(x)
+        stack.extend(reversed([c for c in x._dir if isinstance(c, Element)]))
+    return out
+
+
+def aparseServer(directory):
+    docs = [MOVIES, document(depth=3, fanout=6, namespaces=0.5).encode('utf-8')] + \
+        [s.encode('utf-8') if isinstance(s, str) else s for s in NAMESPACED + SAMPLES]
+
+    async def handle(reader, writer):
+        i = int((await reader.readline()).decode())
+        # small chunks, so documents arrive split inside tags and characters
+        for pos in range(0, len(docs[i]), 7):
+            writer.write(docs[i][pos:pos + 7])
+            await writer.drain()
+        writer.close()
+
+    async def fetch(port, i):
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write('{}\n'.format(i).encode())
+        root = await aparse(reader, bufsize=64)
+        writer.close()
+        return root
+
+    async def run():
+        server = await asyncio.start_server(handle, '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        try:
+            return await asyncio.gather(*[fetch(port, i) for i in range(len(docs))])
+        finally:
+            server.close()
+            await server.wait_closed()
+
+    loop = asyncio.new_event_loop()
+    try:
+        roots = loop.run_until_complete(run())
+    finally:
+        loop.close()
+    for text, root in zip(docs, roots):
+        check(same(parse(text, show=None), root), 'aparse of {}'.format(repr(text)[:60]))
+
+
+def urlServer(directory):
+    docs = [MOVIES, document(depth=3, fanout=6, namespaces=0.5).encode('utf-8')] + \
+        [s.encode('utf-8') if isinstance(s, str) else s for s in NAMESPACED + SAMPLES]
+    broken = b'<a><b></a>'
+    accepted = [0]
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        disable_nagle_algorithm = True
+
+        def setup(self):
+            accepted[0] += 1
+            BaseHTTPRequestHandler.setup(self)
+
+        def log_message(self, *args):
+            pass
+
+        def reply(self, status, body, headers=()):
+            self.send_response(status)
+            for header in headers:
+                self.send_header(*header)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            kind, _, i = self.path.strip('/').partition('/')
+            if kind == 'doc':
+                self.reply(200, docs[int(i)])
+            elif kind == 'chunked':
+                self.send_response(200)
+                self.send_header('Transfer-Encoding', 'chunked')
+                self.end_headers()
+                # small chunks, so documents arrive split inside tags and characters
+                body = docs[int(i)]
+                for pos in range(0, len(body), 7):
+                    piece = body[pos:pos + 7]
+                    self.wfile.write('{:x}\r\n'.format(len(piece)).encode() + piece + b'\r\n')
+                self.wfile.write(b'0\r\n\r\n')
+            elif kind == 'moved':
+                self.reply(301, b'', [('Location', '/found/' + i)])
+            elif kind == 'found':
+                self.reply(302, b'', [('Location', '/doc/' + i)])
+            elif kind == 'broken':
+                self.reply(200, broken)
+            else:
+                self.reply(404, b'<error/>')
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = 'http://127.0.0.1:{}'.format(server.server_port)
+    try:
+        pool = ConnectionPool()
+        for kind in ('doc', 'chunked', 'moved'):
+            for i, text in enumerate(docs):
+                url = '{}/{}/{}'.format(base, kind, i)
+                check(same(parse(text, show=None), parse_url(url, pool)),
+                      'parse_url of {}'.format(url))
+        # one request after another on one pool needs a single connection
+        check(accepted[0] != 1, 'connections accepted: {}'.format(accepted[0]))
+        check(pool.created != 1 or pool.reused <= 0,
+              'connections created {}, reused {}'.format(pool.created, pool.reused))
+        pool.close()
+
+        urls = ['{}/{}/{}'.format(base, kind, i) for kind in ('doc', 'chunked', 'moved')
+                for i in range(len(docs))]
+        results = list(parse_urls(urls + [base + '/missing', base + '/broken'], 4))
+        check([r[0] for r in results] != urls + [base + '/missing', base + '/broken'], 'parse_urls order')
+        for (url, element, error), text in zip(results, docs * 3):
+            check(error or same(parse(text, show=None), element), 'parse_urls of {}'.format(url))
+        check(results[-2][1:] != (None, 'HTTPException: 404 Not Found for {}/missing'.format(base)),
+              '404: {}'.format(results[-2]))
+        expected = attempt(lambda: parse(broken, show=None))['error']
+        check(results[-1][1] is not None or not results[-1][2].startswith(expected + ': '),
+              'malformed body: {}'.format(results[-1]))
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def iterparseRecords(directory):
+    root = parse(MOVIES, show=None)
+    movies = root['movie':]
+    found = list(iterparse(io.BytesIO(MOVIES), 'movie', bufsize=100))
+    check(len(found) != len(movies) and '{} != {}'.format(len(found), len(movies)), 'movie count')
+    for a, b in zip(movies, found):
+        check(same(a, b), 'iterparse record')
+    text = document(depth=3, fanout=5, seed=3)
+    byDepth = list(iterparse(io.StringIO(text), depth=2))
+    expected = [y for x in parse(text, show=None)._dir if isinstance(x, Element)
+                for y in x._dir if isinstance(y, Element)]
+    check(len(byDepth) != len(expected) and len(byDepth), 'elements at depth 2')
+    for a, b in zip(expected, byDepth):
+        check(same(a, b), 'iterparse by depth')
+
+
+def selectPaths(directory):
+    root = parse(MOVIES, show=None)
+    movies = root['movie':]
+    check([str(x) for x in root.select('movie/type')] != [str(m.type) for m in movies], 'movie/type')
+    check(root.select('//year') != [m['year'] for m in movies if m['year':]], '//year')
+    check(root.select('movie[@title="Trigun"]') != [m for m in movies if m('title') == 'Trigun'],
+          'attribute predicate')
+    check(root.select('movie[episodes]') != [m for m in movies if m['episodes':]], 'child predicate')
+    check(root.select('movie[2]') != movies[1:2], 'position')
+    check(sorted(map(id, root.select('//*'))) != sorted(map(id, elements(root)[1:])), '//*')
+    ns = parse(NAMESPACED[3], show=None)
+    check(len(ns.select('p:c/d', {'p': 'urn:p'})) != 1 and 'no match', 'prefixed step')
+    check(len(ns.select('b')) != 1 and 'no match', 'default namespace step')
+    for path in ('./movie', 'movie/..', '.', '//.', 'movie/./type', '1movie', 'movie[@1x]'):
+        check(attempt(lambda: root.select(path)) != {'error': 'ValueError'} and 'accepted',
+              'path {}'.format(path))
+
+
+def parseManyFiles(directory):
+    texts = [MOVIES] + [document(depth=2, fanout=4, seed=i) for i in range(10)]
+    paths = []
+    for i, text in enumerate(texts + ['<broken>']):
+        paths.append(os.path.join(directory, '{}.xml'.format(i)))
+        with open(paths[-1], 'wb') as fo:
+            fo.write(text if isinstance(text, bytes) else text.encode('utf-8'))
+    for workers in (1, 2):
+        results = list(parse_many(paths, workers, chunksize=2))
+        check([r[0] for r in results] != paths, 'order with {} workers'.format(workers))
+        for text, (path, root, error) in zip(texts, results):
+            check(error or same(parse(text, show=None), root), path)
+        check(results[-1][1] is not None or not results[-1][2], 'broken file')
+        unordered = sorted(parse_many(paths, workers, ordered=False), key=lambda r: paths.index(r[0]))
+        check([r[2] is None for r in unordered] != [r[2] is None for r in results], 'unordered')
+
+
+def lazyparseFiles(directory):
+    docs = [MOVIES, document(depth=3, fanout=6, namespaces=0.5, seed=1)] + NAMESPACED + \
+        [s for s in SAMPLES if not isinstance(s, str) or 'ENTITY' not in s]
+    for i, text in enumerate(docs):
+        path = os.path.join(directory, '{}.xml'.format(i))
+        with open(path, 'wb') as fo:
+            fo.write(text if isinstance(text, bytes) else text.encode('utf-8'))
+        expected = parse(text, show=None)
+        check(same(expected, lazyparse(path)), 'lazyparse of {}'.format(repr(text)[:60]))
+        # and with every element unloaded again after use
+        check(same(expected, lazyparse(path, cachesize=1)), 'lazyparse with cachesize=1')
+    root = lazyparse(os.path.join(directory, '0.xml'), cachesize=2)
+    root['movie':][0](title='Changed')
+    for movie in root['movie':]:
+        str(movie)
+    check(root['movie':][0]('title') != 'Changed' and 'edit lost', 'pinned element')
+
+
+def instrumentCounts(directory):
+    root = parse(MOVIES, show=None)
+    instrument = Instrument()
+    ends = []
+    instrument.hook('endDocument', lambda event: ends.append(event))
+    parse(MOVIES, show=None, instrument=instrument)
+    summary = instrument.summary()
+    stats = root.stats()
+    events = summary['events']
+    check(events['startElementNS']['count'] != stats['elements'], 'start events')
+    check(events['endElementNS']['count'] != stats['elements'], 'end events')
+    check(summary['peakDepth'] != stats['depth'], 'peak depth')
+    check(ends != ['endDocument'], 'endDocument hook')
+    check(summary['seconds'] is None or summary['seconds'] < 0, 'parse time')
+
+
+def replayTrace(directory):
+    trace = os.path.join(directory, 'trace')
+    stdin, stdout = sys.stdin, sys.stdout
+    try:
+        # no terminal, so no prompt, and the frames are collected
+        sys.stdin = io.StringIO()
+        for text in [MOVIES] + NAMESPACED:
+            sys.stdout = live = io.StringIO()
+            parse(text, 'live', fps=1e9)
+            parse(text, 'record', trace=trace)
+            sys.stdout = replayed = io.StringIO()
+            replay(trace, fps=1e9)
+            check(live.getvalue() != replayed.getvalue() and 'frames differ',
+                  'replay of {}'.format(repr(text)[:60]))
+    finally:
+        sys.stdin, sys.stdout = stdin, stdout
+
+
+def columnStore(directory):
+    for text in [MOVIES, document(depth=3, fanout=6, text=30, namespaces=0.5)] + NAMESPACED:
+        root = parse(text, show=None)
+        store = parse_columns(text)
+        check(same(root, store.root), 'views of {}'.format(repr(text)[:60]))
+        everything = elements(root)
+        for name in set(x._name for x in everything):
+            named = [x for x in everything if x._name == name]
+            check(store.count(name) != len(named), 'count of {}'.format(name))
+            check(list(store.texts(name)) != [''.join(x.itertext()) for x in named],
+                  'texts of {}'.format(name))
+            check(list(store.texts(name, normalize=True)) != [str(x) for x in named],
+                  'normalised texts of {}'.format(name))
+            for attr in set(k for x in named for k in x._attrs):
+                check(list(store.attributes(name, attr)) != [x._attrs.get(attr) for x in named],
+                      'attribute {} of {}'.format(attr, name))
+
+
+def attempt(fn):
+    """Return fn(), or the name of the exception it raised."""
+    try:
+        return fn()
+    except Exception as e:
+        return {'error': type(e).__name__}
+
+
+def outputs(text):
+    root = parse(text, show=None)
+
+    def write(pretty, fileobj):
+        root.write(fileobj, pretty)
+        return fileobj.getvalue()
+
+    return {'repr': attempt(lambda: root.__repr__(1)),
+            'pretty': attempt(lambda: root.__repr__(1, 1)),
+            'write': attempt(lambda: write(False, io.StringIO())),
+            'writeBytes': attempt(lambda: write(True, io.BytesIO()).decode('utf-8')),
+            'str': [attempt(lambda: str(x)) for x in elements(root)],
+            # leaves first, so every parent is built from memoised child text
+            'strMemo': [attempt(lambda: str(x)) for x in reversed(elements(root))][::-1]}
+
+
+def serialization(directory):
+    with open(EXPECTED) as fo:
+        expected = json.load(fo)
+    for case in expected:
+        text = case['document'].encode('latin-1') if case['bytes'] else case['document']
+        got = outputs(text)
+        for key in ('repr', 'pretty', 'str'):
+            check(got[key] != case[key], '{} of {}'.format(key, repr(text)[:60]))
+        check(got['write'] != case['repr'], 'write() to text of {}'.format(repr(text)[:60]))
+        check(got['writeBytes'] != case['pretty'], 'write() to bytes of {}'.format(repr(text)[:60]))
+        check(got['strMemo'] != case['str'], 'memoised str() of {}'.format(repr(text)[:60]))
+
+
+def updateExpected():
+    expected = []
+    # the long-text sample would make the file ten times bigger
+    for text in [t for t in [MOVIES] + NAMESPACED + SAMPLES if len(t) < 20000]:
+        out = outputs(text)
+        expected.append({'document': text.decode('latin-1') if isinstance(text, bytes) else text,
+                         'bytes': isinstance(text, bytes), 'repr': out['repr'],
+                         'pretty': out['pretty'], 'str': out['str']})
+    with open(EXPECTED, 'w') as fo:
+        json.dump(expected, fo, indent=1, ensure_ascii=False)
+        fo.write('\n')
+
+
+def copies(directory):
+    root = parse(MOVIES, show=None)
+    original = root.__repr__(1)
+    root.movie, str(root), root.digest(), root.stats()  # fill the caches
+    shallow = copy.copy(root)
+    shallow[0] = Element('z')
+    shallow(shelf='Old')
+    del shallow['movie']
+    check(root.__repr__(1) != original and 'original changed', 'copy.copy')
+    check(root.movie('title') != 'Enemy Behind' or root['z':], 'index of the original')
+    check(shallow.z._name != 'z' or shallow.movie('title') != 'Trigun', 'index of the copy')
+    check(shallow.movie is not root['movie':][2] and 'children not shared', 'copy.copy')
+    deep = copy.deepcopy(root)
+    check(same(root, deep), 'copy.deepcopy')
+    deep.movie(title='Changed')
+    check(root.movie('title') != 'Enemy Behind' and 'original changed', 'copy.deepcopy')
+
+
+def spilledText(directory):
+    blob = 'blob {} &lt;&amp;> ]]&gt; \u00e9\U0001f600 '
+    text = '<a>' + ''.join('<b n="{}">{}<c/>{}</b>'.format(i, blob.format(i) * 40, 'x' * (i % 3))
+                           for i in range(600)) + '</a>'
+    fds = '/proc/self/fd'
+    before = len(os.listdir(fds)) if os.path.isdir(fds) else None
+    root = parse(text, show=None, spill=100)
+    expected = parse(text, show=None)
+    spilled = sum(isinstance(x, BigText) for b in root._dir for x in b._dir)
+    check(spilled != 600 and spilled, 'spilled text nodes')
+    if before is not None:
+        # one file and one mapping for the whole parse, not two per node
+        check(len(os.listdir(fds)) - before > 2 and len(os.listdir(fds)) - before, 'descriptors')
+    check(str(root) != str(expected), 'str()')
+    check(root.__repr__(1) != expected.__repr__(1), '__repr__(1)')
+    check(root.__repr__(1, 1) != expected.__repr__(1, 1), '__repr__(1, 1)')
+    for fileobj in (io.StringIO(), io.BytesIO()):
+        root.write(fileobj)
+        check(fileobj.getvalue() != (expected.__repr__(1) if isinstance(fileobj, io.StringIO) else
+                                     expected.__repr__(1).encode('utf-8')), 'write()')
+    check(root.stats() != expected.stats(), 'stats()')
+    check(root.digest() != expected.digest(), 'digest()')
+
+
+def consistent(d, label):
+    """Check d's child index, text and stats against a scan and a fresh start."""
+    for name in set(x._name for x in d._dir if isinstance(x, Element)):
+        scanned = [x for x in d._dir if isinstance(x, Element) and x._name == name]
+        check(d[name:] != scanned, '{}: d[{}:]'.format(label, repr(name)))
+        local = name[1] if isinstance(name, tuple) else name
+        if (name[0] if isinstance(name, tuple) else None) == d._dNS:
+            check(getattr(d, local) is not scanned[0], '{}: d.{}'.format(label, local))
+    again = parse(d.__repr__(1), show=None)
+    check(str(d) != str(again), '{}: str()'.format(label))
+    # a reparse would merge text children that became neighbours
+    check(d.stats() != copy.copy(d).stats(), '{}: stats()'.format(label))
+
+
+def bulkEdits(directory):
+    text = '<r>a<a>1</a>b<b/><a>2</a>a<c/><a>3</a></r>'
+    d = parse(text, show=None)
+    d.a, d['a':], str(d), d.stats()  # fill the index and caches first
+    check(d.replace_all('a', Element('z')) != 3, 'replace_all count')
+    check([x if isinstance(x, str) else x._name for x in d._dir] != ['a', 'z', 'b', 'b', 'a', 'c'],
+          'replace_all keeps text children')
+    consistent(d, 'replace_all')
+    check(d.replace_all('y', [Element('y'), 't']) != 0 or d._dir[-2:] != [d.y, 't'],
+          'replace_all appends a list when nothing matches')
+    consistent(d, 'replace_all append')
+
+    d = parse(text, show=None)
+    d.a
+    check(d.remove_all('a', count=2) != 2 or [str(x) for x in d['a':]] != ['3'], 'remove_all count=')
+    consistent(d, 'remove_all count=')
+    check(d.remove_all('a') != 1 or d['a':] or d._dir.count('a') != 2, 'remove_all')
+    consistent(d, 'remove_all')
+    check(d.remove_all('missing') != 0, 'remove_all with no match')
+
+    d = parse(text, show=None)
+    d.a
+    d.extend([Element('a'), 'tail', Element('e')])
+    check(len(d['a':]) != 4 or d._dir[-2] != 'tail' or d.e._name != 'e', 'extend')
+    consistent(d, 'extend')
+    d.insert_many(1, [Element('a'), Element('f')])
+    check(d._dir[1] is not d.a or d.f is not d._dir[2], 'insert_many')
+    consistent(d, 'insert_many')
+
+    d = parse(text, show=None)
+    d.a
+    d[1:3] = [Element('g')]
+    check(d._dir[1] is not d.g or len(d['a':]) != 2, 'numeric slice assignment')
+    consistent(d, 'numeric slice assignment')
+    del d[0:2]
+    check(d._dir[0]._name != 'b' or d['g':], 'numeric slice deletion')
+    consistent(d, 'numeric slice deletion')
+    d[0] = Element('h')
+    consistent(d, 'item assignment')
+    del d[0]
+    consistent(d, 'item deletion')
+    d['a'] = 'one'
+    check(len(d['a':]) != 1 or str(d.a) != 'one', "d['a'] = v")
+    consistent(d, "d['a'] = v")
+    d['n':] = None
+    check(len(d['n':]) != 1, "d['n':] = v")
+    consistent(d, "d['n':] = v")
+    del d['a':]
+    check(d['a':] and 'left', "del d['a':]")
+    consistent(d, "del d['a':]")
+
+    # names resolve against the default namespace, as d['foo'] does
+    d = parse('<r xmlns="urn:d">a<a/>b<b/><a/><a/></r>', show=None)
+    d.a
+    del d['a']
+    check(len(d['a':]) != 2, "del d['a'] in a default namespace")
+    consistent(d, "del d['a'] in a default namespace")
+    check(d.remove_all('a', 1) != 1 or len(d['a':]) != 1, 'remove_all in a default namespace')
+    check(d.replace_all('a', Element(('urn:d', 'z'))) != 1 or d.z is None, 'replace_all in a default namespace')
+    d.extend([Element(('urn:d', 'a'))])
+    consistent(d, 'bulk edits in a default namespace')
+    check([x for x in d._dir if isinstance(x, str)] != ['a', 'b'], 'text children in a default namespace')
+
+
+def applyDiff(root, changes):
+    """Return a copy of root with the changes from root.diff(other) made."""
+    if changes and changes[0][0] == 'replace' and changes[0][1] == ():
+        return copy.deepcopy(changes[0][3])
+    root = copy.deepcopy(root)
+    attrs, edits = {}, {}
+    for op, path, old, new in changes:
+        if op == 'attrs':
+            attrs[path] = new
+        else:
+            edits.setdefault(path[:-1], []).append((op, path[-1], new))
+    stack = [(root, ())]
+    while stack:
+        element, path = stack.pop()
+        if path in attrs:
+            element._attrs = dict(attrs[path])
+        inserts, gone, replaced = {}, set(), {}
+        for op, i, new in edits.get(path, ()):
+            if op == 'insert':
+                inserts.setdefault(i, []).append(copy.deepcopy(new))
+            elif op == 'delete':
+                gone.add(i)
+            else:
+                replaced[i] = copy.deepcopy(new)
+        children = []
+        for i, x in enumerate(element._dir):
+            children.extend(inserts.get(i, ()))
+            if i in replaced:
+                children.append(replaced[i])
+            elif i not in gone:
+                if isinstance(x, Element):
+                    stack.append((x, path + (i,)))
+                children.append(x)
+        children.extend(inserts.get(len(element._dir), ()))
+        element._dir = children
+    return root
+
+
+def randomTree(rnd, depth=3):
+    element = Element(rnd.choice('abc'), dict((k, rnd.choice('12')) for k in 'xy' if rnd.random() < 0.4))
+    for _ in range(rnd.randrange(5) if depth else 0):
+        if rnd.random() < 0.3:
+            element._dir.append(rnd.choice(['t', 'u', 'v w']))
+        else:
+            element._dir.append(randomTree(rnd, depth - 1))
+    return element
+
+
+def mutate(rnd, root):
+    """Make a few random edits through the Element API."""
+    for _ in range(rnd.randrange(1, 4)):
+        element = rnd.choice(elements(root))
+        roll = rnd.random()
+        if roll < 0.2:
+            element(x=rnd.choice('123'))
+        elif roll < 0.3:
+            element._attrs = {'y': rnd.choice('123')}
+        elif roll < 0.5 and element._dir:
+            del element[rnd.randrange(len(element._dir))]
+        elif roll < 0.7:
+            element.insert_many(rnd.randrange(len(element._dir) + 1), [randomTree(rnd, 1)])
+        elif roll < 0.8 and element._dir:
+            element[rnd.randrange(len(element._dir))] = rnd.choice(['t', 'new text'])
+        elif roll < 0.9:
+            element.extend(['tail'])
+        else:
+            element.replace_all(rnd.choice('abc'), Element('d'))
+
+
+def digestsAndDiffs(directory):
+    rnd = random.Random(18)
+    for case in range(1000):
+        a = randomTree(rnd)
+        b = copy.deepcopy(a)
+        # hashed before the edits, so stale cached digests would show
+        check(a.digest() != b.digest(), 'digest of a copy, case {}'.format(case))
+        mutate(rnd, b)
+        changes = a.diff(b)
+        check(bool(changes) != (a.__repr__(1) != b.__repr__(1)), 'changes found, case {}'.format(case))
+        check(same(applyDiff(a, changes), b), 'diff applied, case {}'.format(case))
+
+    e = parse('<r><a k="1">t</a><b/></r>', show=None)
+    g = parse('<r><a k="2">t</a><b/></r>', show=None)
+    e.digest(), e.stats()
+    e.a._attrs = {'k': '2'}
+    check(e.diff(g) or e.digest() != g.digest(), 'digest after assigning _attrs')
+    e.b._attrs = {'m': '1', 'n': '2'}
+    check(e.stats()['attributes'] != 3, 'stats() after assigning _attrs')
+    e.b._name = 'c'
+    check(str(e.diff(g)[0][0]) != 'replace', 'diff after assigning _name')
+
+
+def cacheRoundTrip(directory):
+    cache = TreeCache(directory)
+    docs = [MOVIES, document(depth=3, fanout=5, attributes=2, namespaces=0.5)] + NAMESPACED + SAMPLES
+    for text in docs:
+        expected = parse(text, show=None)
+        key = cache.key(text)
+        cache.put(key, expected)
+        check(same(expected, cache.get(key)), 'dump/load of {}'.format(repr(text)[:60]))
+
+
+def cacheThroughParse(directory):
+    xt.cache = TreeCache(directory)
+    try:
+        for text in NAMESPACED:
+            first = parse(text, show=None)
+            second = parse(text, show=None)  # a hit
+            check(same(first, second), 'cached parse of {}'.format(text))
+    finally:
+        xt.cache = None
+
+
+def cacheBadFiles(directory):
+    xt.cache = cache = TreeCache(directory)
+    try:
+        text = NAMESPACED[1]
+        expected = parse(text, show=None)
+        path = cache.path(cache.key(text))
+        with open(path, 'rb') as fo:
+            good = fo.read()
+        for label, data in (('empty', b''), ('header only', good[:TreeCache.HEADER.size]),
+                            ('truncated', good[:-6]), ('padded', good + b'\0' * 4),
+                            ('bad magic', b'X' + good[1:]), ('garbage', os.urandom(len(good)))):
+            with open(path, 'wb') as fo:
+                fo.write(data)
+            check(same(expected, parse(text, show=None)), 'parse over a {} cache file'.format(label))
+            check(not gc.isenabled() and 'collector left off', label)
+            check(cache.get(cache.key(text)) is None and 'not stored again', label)
+    finally:
+        xt.cache = None
+
+
+CHECKS = [cacheRoundTrip, cacheThroughParse, cacheBadFiles, aparseServer, urlServer, iterparseRecords,
+          selectPaths, parseManyFiles, lazyparseFiles, instrumentCounts, replayTrace, columnStore,
+          serialization, copies, spilledText, bulkEdits, digestsAndDiffs]
+
+
+def main():
+    if sys.argv[1:] == ['--update-expected']:
+        updateExpected()
+        return 0
+    failures = 0
+    for fn in CHECKS:
+        directory = tempfile.mkdtemp()
+        try:
+            fn(directory)
+            print('ok    {}'.format(fn.__name__))
+        except Exception:
+            failures += 1
+            print('FAIL  {}\n{}'.format(fn.__name__, traceback.format_exc()))
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+    print('{} checks, {} failed'.format(len(CHECKS), failures))
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
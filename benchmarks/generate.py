@@ -0,0 +1,71 @@
+"""Synthetic XML documents for the benchmarks."""
+
+import random
+
+
+def document(depth=3, fanout=4, text=16, attributes=2, namespaces=0.0, seed=0):
+    """Return an XML document as a str.
+
+    depth: levels of elements below the root
+    fanout: child elements of every non-leaf element
+    text: characters of text in every leaf
+    attributes: attributes on every element
+    namespaces: fraction of elements (and of attribute sets) put in a namespace
+    seed: for the random choice of namespaced nodes
+    """
+    rnd = random.Random(seed)
+    prefixes = ['n{}'.format(i) for i in range(4)]
+    words = 'lorem ipsum dolor sit amet consectetur adipiscing elit'.split()
+
+    def name(base):
+        if namespaces and rnd.random() < namespaces:
+            return '{}:{}'.format(rnd.choice(prefixes), base)
+        return base
+
+    def attrs(level):
+        # All or none of an element's attributes are namespaced: Element
+        # cannot sort a mix of plain and namespaced attribute names.
+        prefix = ''
+        if namespaces and rnd.random() < namespaces:
+            prefix = rnd.choice(prefixes) + ':'
+        return ''.join(' {}a{}="v{}"'.format(prefix, i, level * 10 + i) for i in range(attributes))
+
+    def content():
+        out = []
+        size = 0
+        while size < text:
+            word = rnd.choice(words)
+            out.append(word)
+            size += len(word) + 1
+        return ' '.join(out)[:text]
+
+    out = ['<root']
+    if namespaces:
+        out.append(''.join(' xmlns:{}="urn:bench:{}"'.format(p, p) for p in prefixes))
+    out.append(attrs(0) + '>')
+    # (tag, children still to write) for each open element
+    stack = [('root', fanout if depth else 0)]
+    if not depth:
+        out.append(content())
+    while stack:
+        tag, remaining = stack[-1]
+        if not remaining:
+            out.append('</{}>'.format(tag))
+            stack.pop()
+            continue
+        stack[-1] = (tag, remaining - 1)
+        level = len(stack)
+        child = name('e{}'.format(fanout - remaining))
+        out.append('<{}{}>'.format(child, attrs(level)))
+        if level < depth:
+            stack.append((child, fanout))
+        else:
+            out.append(content())
+            out.append('</{}>'.format(child))
+    return ''.join(out)
+
+
+def siblings(count, text=8):
+    """Return a document whose root has count children with distinct names."""
+    return '<root>{}<last>x</last></root>'.format(
+        ''.join('<item{}>{}</item{}>'.format(i, 'x' * text, i) for i in range(count)))
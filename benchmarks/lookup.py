@@ -0,0 +1,25 @@
+"""Time child lookups by name as the number of siblings grows.
+
+Run from the repository root:  python benchmarks/lookup.py
+"""
+
+import os, sys, timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from xmltrampshow.xmltrampshow import parse
+from benchmarks.generate import siblings as document
+
+
+def main():
+    print('{:>10} {:>14} {:>14} {:>14}'.format('siblings', 'getattr us', 'getitem us', 'slice us'))
+    for siblings in (10, 100, 1000, 10000, 100000):
+        root = parse(document(siblings), show=None)
+        number = 10000
+        times = [timeit.timeit(stmt, globals={'root': root}, number=number) / number * 1e6
+                 for stmt in ('root.last', "root['last']", "root['last':]")]
+        print('{:>10} {:>14.3f} {:>14.3f} {:>14.3f}'.format(siblings, *times))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,42 @@
+"""Measure the memory held by a parsed tree, per element.
+
+Run from the repository root:  python -m benchmarks.memory
+"""
+
+import gc, os, sys, tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from xmltrampshow.xmltrampshow import parse, parse_columns
+from benchmarks.generate import document
+
+
+def measure(text, backend):
+    gc.collect()
+    tracemalloc.start()
+    if backend == 'columns':
+        root = parse_columns(text)
+    else:
+        root = parse(text, show=None, backend=backend)
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return size, (root.root if backend == 'columns' else root).stats()
+
+
+def main():
+    shapes = [dict(depth=3, fanout=20, text=8, attributes=1, namespaces=0.0),
+              dict(depth=3, fanout=20, text=8, attributes=1, namespaces=0.5),
+              dict(depth=1, fanout=20000, text=8, attributes=2, namespaces=0.0)]
+    print('{:<48} {:>8} {:>10} {:>14}'.format('shape', 'backend', 'elements', 'bytes/element'))
+    for shape in shapes:
+        text = document(**shape)
+        for backend in ('sax', 'expat', 'columns'):
+            size, stats = measure(text, backend)
+            label = ' '.join('{}={}'.format(k, v) for k, v in sorted(shape.items()))
+            print('{:<48} {:>8} {:>10} {:>14.1f}'.format(label, backend, stats['elements'],
+                                                         float(size) / stats['elements']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+"""Check that the 'expat' backend builds the same trees as 'sax', and time both.
+
+Run from the repository root:  python -m benchmarks.parity
+Exits with status 1 if any document parses differently.
+"""
+
+import io, os, sys, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from xmltrampshow.xmltrampshow import Element, parse
+from benchmarks.generate import document
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+SAMPLES = [
+    '<a/>',
+    '<a>text</a>',
+    '<a>  <b/>  </a>',
+    '<a>x<b>y</b>z<c/>w</a>',
+    '<a><![CDATA[<raw> & ]]> done</a>',
+    '<a>&amp;&lt;&gt;&quot;&apos;&#x41;&#66;</a>',
+    '<!DOCTYPE a [<!ENTITY e "expanded">]><a>&e; and &e;</a>',
+    '<a><!-- comment --><?pi data?>text</a>',
+    '<a xmlns="urn:d"><b xmlns=""><c/></b><d/></a>',
+    '<a xmlns:p="urn:p" p:x="1" p:y="2"><p:b xmlns:p="urn:q" p:z="3"><p:c/></p:b><p:d/></a>',
+    '<a xmlns:p="urn:p" xmlns:q="urn:p"><p:b/><q:c/></a>',
+    '<html xmlns="http://www.w3.org/1999/xhtml"><br/><p>x<br/>y<img src="a"/></p></html>',
+    u'<a t="é中">é中\U0001f600</a>',
+    u'<?xml version="1.0" encoding="ISO-8859-1"?><a>café</a>'.encode('latin-1'),
+    '<a>' + 'long text ' * 10000 + '</a>',
+]
+
+
+def same(a, b):
+    """Return None if the trees are identical, else a description of the first difference."""
+    stack = [(a, b, '')]
+    while stack:
+        x, y, path = stack.pop()
+        if isinstance(x, Element) != isinstance(y, Element):
+            return '{}: {} != {}'.format(path, repr(x), repr(y))
+        if not isinstance(x, Element):
+            if x != y:
+                return '{}: text {} != {}'.format(path, repr(x)[:60], repr(y)[:60])
+            continue
+        for attr in ('_name', '_attrs', '_prefixes', '_dNS'):
+            if getattr(x, attr) != getattr(y, attr):
+                return '{}: {} {} != {}'.format(path, attr, getattr(x, attr), getattr(y, attr))
+        if len(x._dir) != len(y._dir):
+            return '{}: {} children != {}'.format(path, len(x._dir), len(y._dir))
+        for i, (cx, cy) in enumerate(zip(x._dir, y._dir)):
+            stack.append((cx, cy, '{}/{}'.format(path, i)))
+    return None
+
+
+def trace(text, backend):
+    out = io.BytesIO()
+    parse(text, show='record', trace=out, backend=backend)
+    return out.getvalue()
+
+
+def best(fn, repeat=3):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main():
+    with open(os.path.join(HERE, '..', 'xmltrampshow', 'movies.xml'), 'rb') as fo:
+        movies = fo.read()
+    docs = [('movies.xml', movies)] + [('sample {}'.format(i), s) for i, s in enumerate(SAMPLES)]
+    for i, shape in enumerate([dict(depth=3, fanout=6, namespaces=0.0),
+                               dict(depth=3, fanout=6, namespaces=0.7, attributes=3),
+                               dict(depth=60, fanout=1, namespaces=0.3),
+                               dict(depth=1, fanout=500, text=200, attributes=0)]):
+        docs.append(('generated {}'.format(i), document(seed=i, **shape)))
+
+    failures = 0
+    for label, text in docs:
+        for variant in (text, text.encode('utf-8') if isinstance(text, str) else text):
+            problem = same(parse(variant, show=None, backend='sax'), parse(variant, show=None, backend='expat'))
+            if problem is None and trace(variant, 'sax') != trace(variant, 'expat'):
+                problem = 'show events differ'
+            if problem:
+                failures += 1
+                print('MISMATCH {} ({}): {}'.format(label, type(variant).__name__, problem))
+    print('{} documents checked, {} mismatches'.format(2 * len(docs), failures))
+
+    for shape in (dict(depth=3, fanout=20, attributes=2), dict(depth=4, fanout=10, namespaces=0.5),
+                  dict(depth=1, fanout=20000, text=16, attributes=1)):
+        text = document(**shape)
+        sax = best(lambda: parse(text, show=None, backend='sax'))
+        fast = best(lambda: parse(text, show=None, backend='expat'))
+        print('{:>9} bytes  sax {:.4f}s  expat {:.4f}s  speed-up {:.2f}x'.format(len(text), sax, fast, sax / fast))
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
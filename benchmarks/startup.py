@@ -0,0 +1,83 @@
+"""Measure how long importing xmltrampshow takes, and guard what it loads.
+
+Run from the repository root:  python -m benchmarks.startup [--max-ms MS]
+
+Each run is a fresh interpreter under python -X importtime, with bytecode
+cached in a temporary directory so compilation isn't counted. The exit
+status is 1 if the import pulls in any of the modules that should only
+load on first use, if it is slower than --max-ms, or if a 'live' parse
+fails without a terminal.
+"""
+
+import argparse, os, shutil, subprocess, sys, tempfile
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+MODULE = 'xmltrampshow.xmltrampshow'
+
+# loaded on first use only
+LAZY = ('pdb', 'http.client', 'urllib.request', 'ssl', 'email', 'multiprocessing',
+        'concurrent.futures', 'threading', 'xml.sax.expatreader', 'difflib', 'tempfile',
+        'hashlib', 'json', 'shutil')
+
+
+def python(args, cache, **kw):
+    env = dict(os.environ)
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    env['PYTHONPATH'] = os.pathsep.join([ROOT] + [p for p in [env.get('PYTHONPATH')] if p])
+    return subprocess.run([sys.executable, '-X', 'pycache_prefix=' + cache] + args, env=env,
+                          cwd=ROOT, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                          universal_newlines=True, **kw)
+
+
+def importtime(cache):
+    """Return {module: (self us, cumulative us)} for one import of MODULE."""
+    times = {}
+    for line in python(['-X', 'importtime', '-c', 'import ' + MODULE], cache).stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        own, total, name = line[len('import time:'):].split('|')
+        times[name.strip()] = (int(own), int(total))
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=9)
+    parser.add_argument('--max-ms', type=float, default=None)
+    args = parser.parse_args()
+
+    failed = False
+    cache = tempfile.mkdtemp()
+    try:
+        python(['-c', 'import ' + MODULE], cache)  # fill the bytecode cache
+        runs = sorted((importtime(cache) for _ in range(args.runs)), key=lambda t: t[MODULE][1])
+        median = runs[len(runs) // 2]
+        print('import {}: {:.1f} ms (median of {}, best {:.1f} ms)'.format(
+            MODULE, median[MODULE][1] / 1000.0, args.runs, runs[0][MODULE][1] / 1000.0))
+        print('slowest imports by self time:')
+        for name, (own, total) in sorted(median.items(), key=lambda item: -item[1][0])[:10]:
+            print('  {:<36} {:>8.1f} ms'.format(name, own / 1000.0))
+        if args.max_ms is not None and median[MODULE][1] / 1000.0 > args.max_ms:
+            print('FAIL: slower than {} ms'.format(args.max_ms))
+            failed = True
+
+        loaded = python(['-c', 'import sys, {}; print(" ".join(sys.modules))'.format(MODULE)],
+                        cache).stdout.split()
+        eager = [name for name in LAZY if name in loaded]
+        print('modules that should load lazily but were imported: {}'.format(
+            ', '.join(eager) or 'none'))
+        failed = failed or bool(eager)
+
+        # no terminal: stdin and stdout are not ttys, no $COLUMNS
+        live = python(['-c', 'from {} import parse; parse("<a><b>c</b></a>", "live", fps=1000)'
+                       .format(MODULE)], cache, stdin=subprocess.DEVNULL)
+        print('live show without a terminal: {}'.format(
+            'ok' if live.returncode == 0 else 'FAIL\n' + live.stderr))
+        failed = failed or live.returncode != 0
+    finally:
+        shutil.rmtree(cache, ignore_errors=True)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
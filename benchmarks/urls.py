@@ -0,0 +1,89 @@
+"""Compare fetching and parsing documents over HTTP, against a local server.
+
+Run from the repository root:  python -m benchmarks.urls [--latency SECONDS]
+
+The server speaks keep-alive HTTP/1.1 and counts the connections it
+accepts; latency is added to every response to stand in for a network.
+"""
+
+import argparse, os, sys, threading, time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.request import urlopen
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from xmltrampshow.xmltrampshow import parse, parse_url, parse_urls
+from benchmarks.generate import document
+
+
+def serve(docs, latency):
+    accepted = [0]
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        disable_nagle_algorithm = True
+
+        def setup(self):
+            accepted[0] += 1
+            BaseHTTPRequestHandler.setup(self)
+
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            time.sleep(latency)
+            body = docs[self.path]
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/xml')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, accepted
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--documents', type=int, default=40)
+    parser.add_argument('--rounds', type=int, default=5)
+    parser.add_argument('--latency', type=float, default=0.0)
+    args = parser.parse_args()
+
+    docs = dict(('/doc{}.xml'.format(i), document(depth=3, fanout=6, seed=i).encode('utf-8'))
+                for i in range(args.documents))
+    server, accepted = serve(docs, args.latency)
+    base = 'http://127.0.0.1:{}'.format(server.server_port)
+    urls = [base + path for path in sorted(docs)] * args.rounds
+
+    def download():
+        for url in urls:
+            with urlopen(url) as response:
+                parse(response.read(), show=None)
+
+    def sequential():
+        for url in urls:
+            parse_url(url)
+
+    runs = [('urlopen + parse', download), ('parse_url', sequential)]
+    for concurrency in (1, 4, 16):
+        runs.append(('parse_urls concurrency={}'.format(concurrency),
+                     lambda concurrency=concurrency: list(parse_urls(urls, concurrency))))
+
+    print('{} requests of about {} bytes, {}s latency'.format(
+        len(urls), sum(map(len, docs.values())) // len(docs), args.latency))
+    print('{:<28} {:>9} {:>12} {:>12}'.format('', 'seconds', 'requests/s', 'connections'))
+    for label, fn in runs:
+        accepted[0] = 0
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        print('{:<28} {:>9.3f} {:>12.1f} {:>12}'.format(label, elapsed, len(urls) / elapsed,
+                                                       accepted[0]))
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -9,7 +9,7 @@ setup(
     long_description=open('README.md').read(),
     url='https://github.com/brzx/xmltrampShow',
     license='GPLv2',
-    packages=find_packages(),
+    packages=find_packages(exclude=('benchmarks',)),
     zip_safe=False,
     include_package_data=True,
     install_requires=[],
@@ -1,21 +1,25 @@
 """xmltramp: Make XML documents easily accessible."""
 
-from io import BytesIO
+from io import BytesIO, TextIOBase
 from xml.sax.handler import EntityResolver, DTDHandler, ContentHandler, ErrorHandler
-from xml.sax import make_parser
 from xml.sax.handler import feature_namespaces
+from xml.parsers import expat
 
-import os, sys, time
-import pdb
+import os, re, sys, time, struct
+import codecs, gc, mmap, weakref
+from array import array
+from collections import OrderedDict
+from types import MappingProxyType
+
+# Anything else (the SAX reader, http, multiprocessing, threads, hashing,
+# temporary files...) is imported where it is used, to keep importing
+# this module fast for the many short-lived processes that only parse.
 
 PY3 = sys.version_info[0] == 3
 
 if PY3:
     from builtins import range as xrange
     from io import StringIO
-    from http import client as http_client
-    from urllib.parse import urlparse
-    from urllib.request import urlopen
     text_type = str
 else:
     print('Please use Python3 to run this script.')
@@ -35,12 +39,15 @@ def islst(f):
     return isinstance(f, tuple) or isinstance(f, list)
 
 
+# Number of mutations made through the Element API so far, see Element._changed.
+mutations = 0
+
 empty = {'http://www.w3.org/1999/xhtml':
          ['img', 'br', 'hr', 'meta', 'link', 'base', 'param', 'input', 'col', 'area']}
 
 
-def quote(x, elt=True):
-    if elt and '<' in x and len(x) > 24 and x.find(']]>') == -1:
+def quote(x, elt=True, cdata=True):
+    if elt and cdata and '<' in x and len(x) > 24 and x.find(']]>') == -1:
         return "<![CDATA[{}]]>".format(x)
     else:
         x = x.replace('&', '&amp;').replace('<', '&lt;').replace(']]>', ']]&gt;')
@@ -49,32 +56,167 @@ def quote(x, elt=True):
     return x
 
 
+class SpillFile(object):
+    """The temporary file that all the BigText of one parse are written to.
+
+    It is mapped read-only when text is first read from it, and mapped
+    again only if it has grown past the mapping since: one descriptor for
+    the file and one for the mapping, however many texts spill.
+    """
+
+    def __init__(self):
+        import tempfile
+        self.file = tempfile.TemporaryFile()
+        self.size = 0
+        self.map = None
+
+    def write(self, data):
+        self.file.write(data)
+        self.size += len(data)
+
+    def view(self, start, end):
+        if self.map is None or len(self.map) < end:
+            self.file.flush()
+            self.map = memoryview(mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ))
+        return self.map[start:end]
+
+
+class BigText(object):
+    """Text node spilled to a temporary file instead of held as a string.
+
+    Seeder puts these in _dir for text longer than its spill threshold.
+    The text is stored as UTF-8 in the parse's SpillFile: data is a
+    memoryview of its bytes, str() decodes all of it, chunks() a piece at
+    a time.
+    """
+
+    def __init__(self, spill):
+        self.spill = spill
+        self.start = self.end = spill.size
+        self.length = 0
+        self.blank = True
+        self.lt = self.cdataEnd = False
+        self.tail = ''
+
+    def write(self, s):
+        self.length += len(s)
+        self.blank = self.blank and s.isspace()
+        self.lt = self.lt or '<' in s
+        self.cdataEnd = self.cdataEnd or ']]>' in self.tail + s
+        self.tail = (self.tail + s)[-2:]
+        self.spill.write(s.encode('utf-8', 'surrogatepass'))
+
+    def finish(self):
+        self.end = self.spill.size
+        return self
+
+    @property
+    def data(self):
+        return self.spill.view(self.start, self.end)
+
+    def __len__(self):
+        return self.length
+
+    def isspace(self):
+        return self.blank
+
+    def __str__(self):
+        return text_type(self.data, 'utf-8', 'surrogatepass')
+
+    def __repr__(self):
+        return '<BigText of {} characters>'.format(self.length)
+
+    def __reduce__(self):
+        # pickles, e.g. to parse_many's parent process, as a plain string
+        return text_type, (text_type(self),)
+
+    def chunks(self, size=65536):
+        decoder = codecs.getincrementaldecoder('utf-8')('surrogatepass')
+        data = self.data
+        for i in xrange(0, len(data), size):
+            piece = decoder.decode(data[i:i + size])
+            if piece:
+                yield piece
+
+    def quoted(self):
+        """Yield the text escaped as quote() would escape element content."""
+        if self.lt and self.length > 24 and not self.cdataEnd:
+            yield '<![CDATA['
+            for piece in self.chunks():
+                yield piece
+            yield ']]>'
+            return
+        held = ''
+        for piece in self.chunks():
+            text = held + piece
+            # keep back a possible start of ']]>' for the next piece
+            cut = len(text) - 2
+            end = text.rfind(']]>')
+            if end != -1 and end + 3 > cut:
+                cut = end + 3
+            yield quote(text[:cut], True, False)
+            held = text[cut:]
+        yield quote(held, True, False)
+
+
+# Names are (uri, local) tuples; parsers make a new one for every element,
+# so they are interned here to be shared by all elements with that name.
+# Like queries, the table is emptied when it gets big, so a long-running
+# process doesn't keep every name it has ever seen: later elements just
+# stop sharing with earlier ones.
+names = {}
+
+
+def interned(name):
+    if islst(name):
+        if name[0] is None:
+            return name[1]
+        shared = names.get(name)
+        if shared is None:
+            if len(names) >= 65536:
+                names.clear()
+            shared = names[name] = name
+        return shared
+    return name
+
+
+# Read-only uri -> prefix maps with the default namespace, shared by all the
+# elements of a namespace scope, by the prefix -> uri items of the scope.
+# Emptied when it gets big, as names is.
+scopes = {}
+
+
+def prefixmap(prefixes):
+    key = tuple(prefixes.items())
+    scope = scopes.get(key)
+    if scope is None:
+        if len(scopes) >= 4096:
+            scopes.clear()
+        scope = scopes[key] = (MappingProxyType(dict(zip(prefixes.values(), prefixes.keys()))),
+                               prefixes.get(None, None))
+    return scope
+
+
 class Element(object):
+    __slots__ = ('_name', '_attrs', '_dir', '_prefixes', '_dNS', '_index', '_indexed', '_text',
+                 '_stats', '_hash')
+    _memoText = True
+
     def __init__(self, name, attrs=None, children=None, prefixes=None):
-        if islst(name) and name[0] is None:
-            name = name[1]
+        name = interned(name)
         if attrs:
             na = {}
             for k in attrs.keys():
-                if islst(k) and k[0] is None:
-                    na[k[1]] = attrs[k]
-                else:
-                    na[k] = attrs[k]
+                na[interned(k)] = attrs[k]
             attrs = na
 
-        self._name = name
-        self._attrs = attrs or {}
-        self._dir = children or []
-
-        prefixes = prefixes or {}
-        self._prefixes = dict(zip(prefixes.values(), prefixes.keys()))
-
-        if prefixes:
-            self._dNS = prefixes.get(None, None)
-        else:
-            self._dNS = None
+        prefixes, dNS = prefixmap(prefixes or {})
+        setslots(self, name, attrs or {}, children or [], prefixes, dNS)
 
     def __repr__(self, recursive=0, multiline=0, inprefixes=None):
+        if recursive:
+            return ''.join(self._chunks(recursive, multiline, inprefixes))
+
         def qname(name, inprefixes):
             if islst(name):
                 if inprefixes[name[0]] is not None:
@@ -84,29 +226,15 @@ class Element(object):
             else:
                 return name
 
-        def arep(a, inprefixes, addns=1):
-            out = ''
-
-            for p in sorted(self._prefixes.keys()):
-                if p not in inprefixes.keys():
-                    if addns:
-                        out += ' xmlns'
-                    if addns and self._prefixes[p]:
-                        out += ':' + self._prefixes[p]
-                    if addns:
-                        out += '="{}"'.format(quote(p, False))
-                    inprefixes[p] = self._prefixes[p]
-
-            for k in sorted(a.keys()):
-                out += ' ' + qname(k, inprefixes) + '="' + quote(a[k], False) + '"'
-
-            return out
-
         inprefixes = inprefixes or {'http://www.w3.org/XML/1998/namespace': 'xml'}
 
-        # need to call first to set inprefixes:
-        attributes = arep(self._attrs, inprefixes, recursive)
-        out = '<' + qname(self._name, inprefixes) + attributes
+        # need to go through the prefixes first to set inprefixes:
+        for p in self._prefixes.keys():
+            if p not in inprefixes:
+                inprefixes[p] = self._prefixes[p]
+        out = '<' + qname(self._name, inprefixes)
+        for k in sorted(self._attrs.keys()):
+            out += ' ' + qname(k, inprefixes) + '="' + quote(self._attrs[k], False) + '"'
 
         if not self._dir and (self._name[0] in empty.keys() and
                               self._name[1] in empty[self._name[0]]):
@@ -114,59 +242,218 @@ class Element(object):
             return out
 
         out += '>'
+        if self._dir:
+            out += '...'
+        out += '</' + qname(self._name, inprefixes) + '>'
 
-        if recursive:
-            content = 0
-            for x in self._dir:
-                if isinstance(x, Element):
-                    content = 1
+        return out
+
+    def _chunks(self, recursive=1, multiline=0, inprefixes=None):
+        """Yield the pieces of __repr__(recursive, multiline, inprefixes)."""
+        # The walk is iterative and shares one namespace scope: every element
+        # remembers the prefixes it declared and takes them out again when it
+        # is closed, instead of handing a copy of the scope to each child.
+        scope = dict(inprefixes or {'http://www.w3.org/XML/1998/namespace': 'xml'})
 
-            pad = '\n' + ('\t' * recursive)
-            for x in self._dir:
-                if multiline and content:
-                    out += pad
+        def qname(name):
+            if islst(name):
+                if scope[name[0]] is not None:
+                    return scope[name[0]] + ':' + name[1]
+                else:
+                    return name[1]
+            else:
+                return name
+
+        stack = []
+        element, level = self, recursive
+        while True:
+            if element is not None:
+                added = []
+                out = []
+                for p in sorted(element._prefixes.keys()):
+                    if p not in scope:
+                        out.append(' xmlns')
+                        if element._prefixes[p]:
+                            out.append(':' + element._prefixes[p])
+                        out.append('="{}"'.format(quote(p, False)))
+                        scope[p] = element._prefixes[p]
+                        added.append(p)
+                for k in sorted(element._attrs.keys()):
+                    out.append(' ' + qname(k) + '="' + quote(element._attrs[k], False) + '"')
+                yield '<' + qname(element._name) + ''.join(out)
+
+                name = element._name
+                if not element._dir and (name[0] in empty.keys() and name[1] in empty[name[0]]):
+                    yield ' />'
+                    for p in added:
+                        del scope[p]
+                else:
+                    yield '>'
+                    content = False
+                    if multiline:
+                        for x in element._dir:
+                            if isinstance(x, Element):
+                                content = True
+                                break
+                    stack.append((element, iter(element._dir), level, added, content))
+                element = None
+
+            if not stack:
+                return
+            parent, children, level, added, content = stack[-1]
+            for x in children:
+                if content:
+                    yield '\n' + ('\t' * level)
                 if isstr(x):
-                    out += quote(x)
+                    yield quote(x)
+                elif isinstance(x, BigText):
+                    for piece in x.quoted():
+                        yield piece
                 elif isinstance(x, Element):
-                    out += x.__repr__(recursive + 1, multiline, inprefixes.copy())
+                    element = x
+                    level += 1
+                    break
                 else:
                     raise TypeError("I wasn't expecting {}.".format(repr(x)))
-            if multiline and content:
-                out += '\n' + ('\t' * (recursive - 1))
-        else:
-            if self._dir:
-                out += '...'
-
-        out += '</' + qname(self._name, inprefixes) + '>'
-
-        return out
+            else:
+                stack.pop()
+                if content:
+                    yield '\n' + ('\t' * (level - 1))
+                yield '</' + qname(parent._name) + '>'
+                for p in added:
+                    del scope[p]
+
+    def write(self, fileobj, pretty=False, encoding='utf-8', bufsize=65536):
+        """Serialize the tree to fileobj, the same as __repr__(1, pretty).
+
+        The output is streamed in chunks of about bufsize characters rather
+        than built as one string. Text files are written str, anything else
+        gets bytes in encoding.
+        """
+        text = isinstance(fileobj, TextIOBase)
+        buf = []
+        size = 0
+        for chunk in self._chunks(1, pretty):
+            buf.append(chunk)
+            size += len(chunk)
+            if size >= bufsize:
+                data = ''.join(buf)
+                fileobj.write(data if text else data.encode(encoding, 'xmlcharrefreplace'))
+                buf = []
+                size = 0
+        if buf:
+            data = ''.join(buf)
+            fileobj.write(data if text else data.encode(encoding, 'xmlcharrefreplace'))
+
+    def _changed(self, appended=False):
+        # Values cached from a whole subtree (like the text below) are stamped
+        # with the mutation count they were computed at: elements don't know
+        # their parents, so an edit anywhere has to invalidate them all.
+        # The child index survives appends, _lookup picks those up itself.
+        global mutations
+        mutations += 1
+        if not appended:
+            self._index = None
+
+    def itertext(self):
+        """Yield the text children of this element and its descendants in order."""
+        stack = [iter(self._dir)]
+        while stack:
+            for x in stack[-1]:
+                if isinstance(x, Element):
+                    stack.append(iter(x._dir))
+                    break
+                # "six.text_type" is unicode in Python 2 and str in Python 3.
+                yield x if isstr(x) else text_type(x)
+            else:
+                stack.pop()
 
     def __str__(self):
-        text = u''
-        for x in self._dir:
-            # "six.text_type" is unicode in Python 2 and str in Python 3.
-            text += text_type(x)
-        return ' '.join(text.split())
+        if self._text is not None and self._text[0] == mutations:
+            return self._text[1]
+
+        # This gives the same result as concatenating str() of every child and
+        # normalising the whitespace, but in a single pass: whitespace at the
+        # edges of a child element is dropped, as its own str() would have.
+        out = []
+        space = False
+        stack = [[iter(self._dir), False]]  # children, has output any words
+        while stack:
+            top = stack[-1]
+            for x in top[0]:
+                if isinstance(x, Element):
+                    if x._text is not None and x._text[0] == mutations:
+                        if x._text[1]:
+                            if space:
+                                out.append(' ')
+                            out.append(x._text[1])
+                            space = False
+                            top[1] = True
+                        continue
+                    stack.append([iter(x._dir), False])
+                    break
+                if not isstr(x):
+                    x = text_type(x)
+                words = x.split()
+                if not words:
+                    if x and top[1]:
+                        space = True
+                    continue
+                if space or (top[1] and x[0].isspace()):
+                    out.append(' ')
+                out.append(' '.join(words))
+                space = x[-1].isspace()
+                top[1] = True
+            else:
+                stack.pop()
+                if top[1]:
+                    space = False
+                    if stack:
+                        stack[-1][1] = True
+
+        text = ''.join(out)
+        if self._memoText:
+            self._text = (mutations, text)
+        return text
+
+    def _lookup(self, n):
+        """Return the positions in _dir of the child elements named n."""
+        # The index is built lazily and extended with whatever was appended
+        # to _dir since (that is how Seeder grows it); any other mutation
+        # goes through the methods below, which drop it.
+        index = self._index
+        if index is None or self._indexed > len(self._dir):
+            index = self._index = {}
+            self._indexed = 0
+        if self._indexed < len(self._dir):
+            dir = self._dir
+            for i in xrange(self._indexed, len(dir)):
+                x = dir[i]
+                if isinstance(x, Element):
+                    if x._name in index:
+                        index[x._name].append(i)
+                    else:
+                        index[x._name] = [i]
+            self._indexed = len(dir)
+        return index.get(n, ())
 
     def __getattr__(self, n):
         if n[0] == '_':
             raise AttributeError("Use foo['{}'] to access the child element.".format(n))
         if self._dNS:
             n = (self._dNS, n)
-        for x in self._dir:
-            if isinstance(x, Element) and x._name == n:
-                return x
+        for i in self._lookup(n):
+            return self._dir[i]
         raise AttributeError('No child element named {}'.format(repr(n)))
 
     def __hasattr__(self, n):
-        for x in self._dir:
-            if isinstance(x, Element) and x._name == n:
-                return True
-        return False
+        return bool(self._lookup(n))
 
     def __setattr__(self, n, v):
         if n[0] == '_':
-            self.__dict__[n] = v
+            object.__setattr__(self, n, v)
+            if n in ('_dir', '_attrs', '_name'):
+                self._changed()
         else:
             self[n] = v
 
@@ -182,23 +469,26 @@ class Element(object):
             n = n.start
             if self._dNS and not islst(n):
                 n = (self._dNS, n)
-            out = []
-            for x in self._dir:
-                if isinstance(x, Element) and x._name == n:
-                    out.append(x)
-            return out
+            dir = self._dir
+            return [dir[i] for i in self._lookup(n)]
         else:  # d['foo'] == first <foo>
             if self._dNS and not islst(n):
                 n = (self._dNS, n)
-            for x in self._dir:
-                if isinstance(x, Element) and x._name == n:
-                    return x
+            for i in self._lookup(n):
+                return self._dir[i]
             raise KeyError(n)
 
     def __setitem__(self, n, v):
         if isinstance(n, int):  # d[1]
             self._dir[n] = v
+            self._changed()
         elif isinstance(n, slice):
+            # numerical slices
+            if isinstance(n.start, int) or n == slice(None):
+                self._dir[n.start:n.stop] = v
+                self._changed()
+                return
+
             # d['foo':] adds a new foo
             n = n.start
             if self._dNS and not islst(n):
@@ -206,6 +496,7 @@ class Element(object):
 
             nv = Element(n)
             self._dir.append(nv)
+            self._changed(True)
 
         else:  # d["foo"] replaces first <foo> and dels rest
             if self._dNS and not islst(n):
@@ -213,39 +504,78 @@ class Element(object):
 
             nv = Element(n)
             nv._dir.append(v)
-            replaced = False
-
-            todel = []
-            for i in xrange(len(self)):
-                if self[i]._name == n:
-                    if replaced:
-                        todel.append(i)
-                    else:
-                        self[i] = nv
-                        replaced = True
-            if not replaced:
-                self._dir.append(nv)
-            for i in sorted(todel, reverse=True):
-                del self[i]
+            self.replace_all(n, nv)
 
     def __delitem__(self, n):
         if isinstance(n, int):
             del self._dir[n]
+            self._changed()
         elif isinstance(n, slice):
-            # delete all <foo>s
-            n = n.start
-            if self._dNS and not islst(n):
-                n = (self._dNS, n)
-
-            for i in reversed(range(len(self))):
-                if self[i]._name == n:
-                    del self[i]
+            if isinstance(n.start, int) or n == slice(None):
+                del self._dir[n.start:n.stop]
+                self._changed()
+            else:
+                # delete all <foo>s
+                self.remove_all(n.start)
         else:
             # delete first foo
-            for i in range(len(self)):
-                if self[i]._name == n:
-                    del self[i]
-                    break
+            self.remove_all(n, 1)
+
+    # Bulk edits: each rebuilds _dir in one pass and invalidates caches once.
+    # Names are looked up as in d['foo']; text children are never matched.
+
+    def replace_all(self, n, v):
+        """Put v where the first <n> child is and remove the other <n>s.
+
+        v is a child or a list of children, appended if there is no <n>.
+        Returns the number of <n> children taken out.
+        """
+        if self._dNS and not islst(n):
+            n = (self._dNS, n)
+        new = list(v) if islst(v) else [v]
+        dir = []
+        found = 0
+        for x in self._dir:
+            if isinstance(x, Element) and x._name == n:
+                if not found:
+                    dir.extend(new)
+                found += 1
+            else:
+                dir.append(x)
+        if not found:
+            dir.extend(new)
+        self._dir[:] = dir
+        self._changed()
+        return found
+
+    def remove_all(self, n, count=None):
+        """Remove the <n> children, or only the first count of them.
+
+        Returns the number removed.
+        """
+        if self._dNS and not islst(n):
+            n = (self._dNS, n)
+        dir = []
+        removed = 0
+        for x in self._dir:
+            if isinstance(x, Element) and x._name == n and (count is None or removed < count):
+                removed += 1
+            else:
+                dir.append(x)
+        if removed:
+            self._dir[:] = dir
+            self._changed()
+        return removed
+
+    def extend(self, children):
+        """Append children, elements and text alike."""
+        self._dir.extend(children)
+        self._changed(True)
+
+    def insert_many(self, i, children):
+        """Insert children before position i."""
+        self._dir[i:i] = list(children)
+        self._changed()
 
     def __call__(self, *_pos, **_set):
         if _set:
@@ -254,6 +584,8 @@ class Element(object):
         if len(_pos) > 1:
             for i in range(0, len(_pos), 2):
                 self._attrs[_pos[i]] = _pos[i + 1]
+        if _set or len(_pos) > 1:
+            self._changed()
         if len(_pos) == 1:
             return self._attrs[_pos[0]]
         if len(_pos) == 0:
@@ -262,33 +594,237 @@ class Element(object):
     def __len__(self):
         return len(self._dir)
 
-    def getMaxLevel(self, son=None):
-        if son is None:
-            level = 0
-            if len(self._dir) == 0:
-                return level
-            elif len(self._dir) == 1:
-                if isinstance(self._dir[0], Element):
-                    level = self.getMaxLevel(self._dir[0]) + 1
-                return level
+    def __reduce__(self):
+        # Pickle the whole subtree as one flat preorder list, with each
+        # distinct prefix map stored once: no recursion and no per-object
+        # pickle overhead. Cached indexes and text are left behind.
+        nodes = []
+        maps = []
+        mapids = {}
+        stack = [self]
+        while stack:
+            x = stack.pop()
+            if isinstance(x, Element):
+                key = tuple(x._prefixes.items())
+                if key not in mapids:
+                    mapids[key] = len(maps)
+                    maps.append(dict(x._prefixes))
+                nodes.append((x._name, x._attrs, mapids[key], x._dNS, len(x._dir)))
+                stack.extend(reversed(x._dir))
             else:
-                ll = [self.getMaxLevel(ss) for ss in self._dir if isinstance(ss, Element)]
-                if len(ll) > 0:
-                    level = max(ll) + 1
-                return level
-        else:
-            level = 0
-            if len(son._dir) == 0:
-                return level
-            elif len(son._dir) == 1:
-                if isinstance(son._dir[0], Element):
-                    level = self.getMaxLevel(son._dir[0]) + 1
-                return level
+                nodes.append(x)
+        return rebuild, (nodes, maps)
+
+    @classmethod
+    def _make(cls, name, attrs, children, prefixes, dNS):
+        # Build an Element from already normalised parts, skipping __init__.
+        element = cls.__new__(cls)
+        setslots(element, name, attrs, children, prefixes, dNS)
+        return element
+
+    def __copy__(self):
+        # Children are shared, but not the list that holds them, the
+        # attributes, or anything cached about them.
+        return Element._make(self._name, dict(self._attrs), list(self._dir), self._prefixes,
+                             self._dNS)
+
+    def stats(self):
+        """Return statistics about the tree below this element as a dict.
+
+        depth: number of elements on the longest path down, 1 for a leaf
+        elements, texts, attributes: how many of each the tree holds
+        fanout: the largest number of children of any one element
+
+        Seeder fills these in for the root while parsing; otherwise they are
+        computed iteratively and cached until the next mutation.
+        """
+        if self._stats is None or self._stats[0] != mutations:
+            depth = elements = texts = attributes = fanout = 0
+            stack = [(self, 1)]
+            while stack:
+                element, level = stack.pop()
+                elements += 1
+                attributes += len(element._attrs)
+                if level > depth:
+                    depth = level
+                if len(element._dir) > fanout:
+                    fanout = len(element._dir)
+                for x in element._dir:
+                    if isinstance(x, Element):
+                        stack.append((x, level + 1))
+                    else:
+                        texts += 1
+            self._stats = (mutations, {'depth': depth, 'elements': elements, 'texts': texts,
+                                       'attributes': attributes, 'fanout': fanout})
+        return dict(self._stats[1])
+
+    def digest(self):
+        """Return a hash of the tree below this element as 16 bytes.
+
+        It covers names, attributes and children in order, but not how
+        namespaces were declared, so equal subtrees have equal digests
+        wherever they occur. Computed iteratively and cached like stats():
+        the cache is stamped with the module-wide mutation count, so after
+        any edit through the Element API, to this tree or any other, the
+        next call hashes the whole tree again.
+        """
+        if self._hash is not None and self._hash[0] == mutations:
+            return self._hash[1]
+        if newhash is None:
+            hashfactory()
+        stack = [(self, iter(self._dir), hashhead(self))]
+        while stack:
+            element, children, h = stack[-1]
+            for x in children:
+                if isinstance(x, Element):
+                    if x._hash is not None and x._hash[0] == mutations:
+                        h.update(b'e' + x._hash[1])
+                        continue
+                    stack.append((x, iter(x._dir), hashhead(x)))
+                    break
+                hashtext(h, x)
             else:
-                ll = [self.getMaxLevel(ss) for ss in son._dir if isinstance(ss, Element)]
-                if len(ll) > 0:
-                    level = max(ll) + 1
-                return level
+                stack.pop()
+                sethash(element, (mutations, h.digest()[:16]))
+                if stack:
+                    stack[-1][2].update(b'e' + element._hash[1])
+        return self._hash[1]
+
+    def diff(self, other):
+        """Return the changes that turn this tree into other.
+
+        A list of (op, path, old, new) in document order; path holds the
+        positions in _dir that lead from this element to the node:
+          'attrs'    the element at path has attributes old, in other new
+          'replace'  the child old at path is new in other
+          'delete'   the child old at path is gone (new is None)
+          'insert'   new comes before the child at path (old is None)
+        Subtrees with the same digest() are skipped without a look inside,
+        so past hashing the two trees the work follows the changes. As
+        with digest(), an edit anywhere since they were hashed means both
+        trees are hashed in full again first.
+        """
+        if self._name != other._name:
+            return [('replace', (), self, other)]
+        import difflib
+        changes = []
+        stack = [(self, other, ())]
+        while stack:
+            a, b, path = stack.pop()
+            if a.digest() == b.digest():
+                continue
+            if a._attrs != b._attrs:
+                changes.append(('attrs', path, a._attrs, b._attrs))
+            old, new = a._dir, b._dir
+            ka, kb = [childkey(x) for x in old], [childkey(x) for x in new]
+            # only the middle that differs goes to the (quadratic) matcher
+            lo = 0
+            while lo < len(ka) and lo < len(kb) and ka[lo] == kb[lo]:
+                lo += 1
+            hi = 0
+            while (hi < len(ka) - lo and hi < len(kb) - lo and
+                   ka[len(ka) - 1 - hi] == kb[len(kb) - 1 - hi]):
+                hi += 1
+            matcher = difflib.SequenceMatcher(None, ka[lo:len(ka) - hi], kb[lo:len(kb) - hi],
+                                              autojunk=False)
+            pairs = []
+            for op, i1, i2, j1, j2 in matcher.get_opcodes():
+                i1, i2, j1, j2 = i1 + lo, i2 + lo, j1 + lo, j2 + lo
+                if op == 'equal':
+                    continue
+                if op == 'replace':
+                    # pair children off in order, looking inside same-named elements
+                    k = min(i2 - i1, j2 - j1)
+                    for d in xrange(k):
+                        x, y = old[i1 + d], new[j1 + d]
+                        if isinstance(x, Element) and isinstance(y, Element) and x._name == y._name:
+                            pairs.append((x, y, path + (i1 + d,)))
+                        else:
+                            changes.append(('replace', path + (i1 + d,), x, y))
+                    i1, j1 = i1 + k, j1 + k
+                for d in xrange(i1, i2):
+                    changes.append(('delete', path + (d,), old[d], None))
+                for d in xrange(j1, j2):
+                    changes.append(('insert', path + (i2,), None, new[d]))
+            stack.extend(reversed(pairs))
+        changes.sort(key=lambda change: change[1])
+        return changes
+
+    def select(self, path, namespaces=None):
+        """Return the elements matching path, see Query."""
+        return query(path, namespaces).select(self)
+
+    def getMaxLevel(self, son=None):
+        if son is None:
+            son = self
+        return son.stats()['depth'] - 1
+
+# Slot setters that bypass Element.__setattr__, for building elements fast.
+setname, setattrs, setdir, setprefixes, setdNS, setindex, setindexed, settext, setstats, sethash = \
+    [getattr(Element, n).__set__ for n in Element.__slots__]
+
+
+def setslots(element, name, attrs, children, prefixes, dNS):
+    setname(element, name)
+    setattrs(element, attrs)
+    setdir(element, children)
+    setprefixes(element, prefixes)
+    setdNS(element, dNS)
+    setindex(element, None)
+    setindexed(element, 0)
+    settext(element, None)
+    setstats(element, None)
+    sethash(element, None)
+
+
+# Merkle hashing for Element.digest(): every field is length-prefixed, and
+# children are added as the digests of their subtrees.
+
+# returns a new hash object, set by the first digest() rather than per
+# element: blake2b where hashlib has it (3.6 on), else sha1. Either way
+# only the first 16 bytes of a digest are used.
+newhash = None
+
+
+def hashfactory():
+    global newhash
+    try:
+        from hashlib import blake2b
+        newhash = lambda: blake2b(digest_size=16)
+    except ImportError:
+        from hashlib import sha1 as newhash
+
+
+def hashhead(element):
+    h = newhash()
+    attrs = element._attrs
+    data = repr((element._name, sorted(attrs.items(), key=repr) if attrs else ()))
+    data = data.encode('utf-8', 'surrogatepass')
+    h.update(b'e' + struct.pack('<Q', len(data)) + data)
+    return h
+
+
+def hashtext(h, x):
+    if isinstance(x, BigText):
+        h.update(b't' + struct.pack('<Q', x.end - x.start))
+        h.update(x.data)
+    else:
+        data = (x if isstr(x) else text_type(x)).encode('utf-8', 'surrogatepass')
+        h.update(b't' + struct.pack('<Q', len(data)) + data)
+
+
+def childkey(x):
+    """What Element.diff matches children by: digests, or the text itself."""
+    if isinstance(x, Element):
+        return x.digest()
+    if isinstance(x, BigText):
+        if newhash is None:
+            hashfactory()
+        h = newhash()
+        hashtext(h, x)
+        return 't', h.digest()[:16]
+    return x
+
 
 class Namespace(object):
     def __init__(self, uri):
@@ -301,14 +837,194 @@ class Namespace(object):
         return (self.__uri, n)
 
 
-nprint = lambda x: print(x, end='')
+class Query(object):
+    """A compiled path expression over Element trees (a subset of XPath).
+
+    Paths are steps separated by '/' (children) or '//' (descendants),
+    starting from the element the query runs on:
+
+        /soapenv:Body//doc:record[@id]
+        movie[@title="Trigun"]/type
+        //*[2]
+
+    A step is a name, prefix:name or *, followed by any number of
+    predicates: [@attr], [@attr="value"], [child] or a 1-based position.
+    There are no . and .. steps: elements don't know their parents.
+    namespaces maps prefixes to a Namespace or a URI; unprefixed names use
+    the None entry if there is one, otherwise the default namespace of the
+    element they are looked up in, as d['foo'] does.
+    """
+
+    # names start with a letter or _, so . and .. don't pass for names
+    step = re.compile(r'''(//?)(\*|[^\W\d][\w.-]*(?::[^\W\d][\w.-]*)?)((?:\[(?:[^\]'"]|'[^']*'|"[^"]*")*\])*)''')
+    predicate = re.compile(r'''\[((?:[^\]'"]|'[^']*'|"[^"]*")*)\]''')
+    attribute = re.compile(r'''^@([^\W\d][\w.-]*(?::[^\W\d][\w.-]*)?)\s*(?:=\s*(?:'([^']*)'|"([^"]*)"))?$''')
+    child = re.compile(r'^[^\W\d][\w.-]*(?::[^\W\d][\w.-]*)?$')
+
+    def __init__(self, path, namespaces=None):
+        self.path = path
+        self.namespaces = namespaces or {}
+        self.steps = []
+        if not path.startswith('/'):
+            path = '/' + path
+        pos = 0
+        while pos < len(path):
+            m = self.step.match(path, pos)
+            if not m and path[pos:].lstrip('/').startswith('.'):
+                raise ValueError('No . or .. steps in paths, in {}.'.format(repr(self.path)))
+            if not m:
+                raise ValueError('Bad path {} at {}.'.format(repr(self.path), pos))
+            axis, test, predicates = m.groups()
+            self.steps.append((axis == '//', self.name(test),
+                               [self.compilePredicate(p) for p in self.predicate.findall(predicates)]))
+            pos = m.end()
+        if not self.steps:
+            raise ValueError('Empty path.')
+
+    def name(self, test):
+        # -> (resolved name or None, local name), or (None, None) for *
+        if test == '*':
+            return None, None
+        if ':' in test:
+            prefix, local = test.split(':', 1)
+            if prefix not in self.namespaces:
+                raise ValueError('Unknown prefix {} in {}.'.format(repr(prefix), repr(self.path)))
+            ns = self.namespaces[prefix]
+        elif None in self.namespaces:
+            ns, local = self.namespaces[None], test
+        else:
+            return None, test
+        return (ns[local] if isinstance(ns, Namespace) else (ns, local)), local
+
+    def compilePredicate(self, predicate):
+        predicate = predicate.strip()
+        if predicate.isdigit():
+            return int(predicate)
+        m = self.attribute.match(predicate)
+        if m:
+            key, value = m.group(1), m.group(2) if m.group(2) is not None else m.group(3)
+            if ':' in key:
+                key = self.name(key)[0]
+            if value is None:
+                return lambda x: key in x._attrs
+            return lambda x: x._attrs.get(key) == value
+        if self.child.match(predicate):
+            name, local = self.name(predicate)
+            if name is None:
+                return lambda x: bool(x._lookup((x._dNS, local) if x._dNS else local))
+            return lambda x: bool(x._lookup(name))
+        raise ValueError('Unsupported predicate [{}] in {}.'.format(predicate, repr(self.path)))
+
+    def children(self, parent, name, local, byindex):
+        if local is None:
+            return [x for x in parent._dir if isinstance(x, Element)]
+        if name is None:
+            name = (parent._dNS, local) if parent._dNS else local
+        if byindex:
+            dir = parent._dir
+            return [dir[i] for i in parent._lookup(name)]
+        return [x for x in parent._dir if isinstance(x, Element) and x._name == name]
+
+    def select(self, element):
+        context = [element]
+        for descendants, (name, local), predicates in self.steps:
+            out = []
+            seen = set()
+            for parent in context:
+                if descendants:
+                    # Apply the step to every element of the subtree, scanning
+                    # their children directly instead of indexing each one.
+                    parents = []
+                    stack = [parent]
+                    while stack:
+                        x = stack.pop()
+                        parents.append(x)
+                        stack.extend(reversed([c for c in x._dir if isinstance(c, Element)]))
+                else:
+                    parents = [parent]
+                for p in parents:
+                    matches = self.children(p, name, local, not descendants)
+                    for predicate in predicates:
+                        if isinstance(predicate, int):
+                            matches = matches[predicate - 1:predicate] if predicate > 0 else []
+                        else:
+                            matches = [x for x in matches if predicate(x)]
+                    for x in matches:
+                        if id(x) not in seen:
+                            seen.add(id(x))
+                            out.append(x)
+            context = out
+        return context
+
+
+def rebuild(nodes, maps):
+    """Unpickle an Element flattened by Element.__reduce__."""
+    root = None
+    stack = []  # [element, children still to come]
+    maps = [MappingProxyType(m) for m in maps]
+    for node in nodes:
+        if isinstance(node, tuple):
+            name, attrs, prefixes, dNS, n = node
+            x = Element._make(interned(name), dict((interned(k), v) for k, v in attrs.items()),
+                              [], maps[prefixes], dNS)
+        else:
+            x, n = node, 0
+        if stack:
+            stack[-1][0]._dir.append(x)
+            stack[-1][1] -= 1
+        else:
+            root = x
+        if n:
+            stack.append([x, n])
+        while stack and not stack[-1][1]:
+            stack.pop()
+    return root
+
+
+# Compiled queries by path and namespace URIs, see query.
+queries = {}
+
+
+def query(path, namespaces=None):
+    """Return the compiled Query for path, reusing it if it was seen before."""
+    key = (path, tuple(sorted((repr(k), v[''][0] if isinstance(v, Namespace) else v)
+                              for k, v in (namespaces or {}).items())))
+    q = queries.get(key)
+    if q is None:
+        if len(queries) >= 256:
+            queries.clear()
+        q = queries[key] = Query(path, namespaces)
+    return q
+
 
 class StackShow:
-    def __init__(self, sleep):
-        self.sleep = sleep
-        self.columns, self.lines = os.get_terminal_size()
-        self.vinte, self.vrem = divmod(self.columns, 12)
+    """Animate the parser stack in the terminal.
+
+    Each frame is built as a list of rows and compared with the one on
+    screen; only the rows that changed are rewritten, with ANSI cursor
+    positioning and a single write. sleep is the delay between steps, fps
+    (if given) sets it as a rate instead. size is (columns, lines), the
+    terminal's by default.
+
+    Only the top of a deep stack is drawn, as many blocks as fit across
+    the screen, with the depth shown above them. Blocks are as tall as the
+    screen allows and are only rebuilt when their element changes.
+    """
+
+    def __init__(self, sleep=3, fps=None, out=None, size=None):
+        self.sleep = 1.0 / fps if fps else sleep
+        self.out = out or sys.stdout
+        if size is None:
+            # falls back to $COLUMNS and $LINES, then 80x24, with no terminal
+            import shutil
+            size = shutil.get_terminal_size()
+        self.columns, self.lines = size
+        self.window = max(1, (self.columns - 2) // 12)
+        self.height = max(4, self.lines - 17)
         self.vi, _ = divmod(self.columns, 2)
+        self.labels = {}
+        self.frame = []
+        self.due = None
         self.sprint([], 'Initial an empty stack for parsing xml.', '')
 
     def getFirstLineMsg(self, operation, value):
@@ -333,144 +1049,1583 @@ class StackShow:
                 return ' ' * row_length
         return ['{}'.format(gg(nmsg, vl, nvi, nvr)) for vl in range(1, 7)]
 
-    def getBlock(self, ss):
-        def getStr(nss, num, inte, rem):
-            if num <= inte:
-                return nss[(num-1)*10 : (num-1)*10+10]
-            elif num == inte + 1:
-                return '{}{}'.format(nss[inte*10 : ], ' ' * (10-rem))
-            else:
-                return ' ' * 10
-        nss = ss[:40]
-        inte, rem = divmod(len(nss), 10)
+    def getBlock(self, ss, height=4):
+        nss = ss[:10 * height]
         line1, line6 = '{}{}{}'.format('|', '-' * 10, '|'), '{}{}{}'.format('|', '-' * 10, '|')
-        return [line1] + ['{}{}{}'.format('|', getStr(nss, vl, inte, rem), '|') for vl in range(1, 5)] + [line6]
-
-    def sprint(self, stack, operation, value):
+        return [line1] + ['|' + nss[i * 10:i * 10 + 10].ljust(10) + '|' for i in range(height)] + [line6]
+
+    def getLabel(self, element, labels):
+        # repr() of an element on the stack only changes when it gets its
+        # first child, so its block is kept until then
+        full = len(element._dir) > 0
+        label = self.labels.get(id(element))
+        if label is None or label[0] is not element or label[1] != full:
+            label = (element, full, self.getBlock(repr(element), self.height))
+        labels[id(element)] = label
+        return label[2]
+
+    def getFrame(self, stack, operation, value):
+        columns = self.columns
         length = len(stack)
+
+        rows = ['-' * columns,
+                '| Message: ' + operation + ' ' * (columns - 12 - len(operation)) + '|',
+                '-' * columns]
         if length == 0:
-            nprint('-' * self.columns)
-            nprint('| Message: '); nprint(operation); nprint(' ' * (self.columns-12-len(operation))); nprint('|')
-            nprint('-' * self.columns)
-            def pr1():
-                nprint('|'); nprint(' ' * (self.columns-2)); nprint('|')
-            [pr1() for _ in range(6)]
-            nprint('-' * self.columns)
-            nprint('*' * self.columns)
-            nprint('* Stack:  bottom >------> top'); nprint(' ' * (self.columns-30)); nprint('*')
-            nprint('*' * self.columns)
-            def pr2():
-                nprint('>'); nprint(' ' * (self.columns-2)); nprint('>')
-            [pr2() for _ in range(6)]
-            nprint('*' * self.columns)
-        elif length <= self.vinte:
-            msgbox = self.getFirstLineMsg(operation, value)
-            nline1, nline2, nline3, nline4, nline5, nline6 = self.getMsgBox(msgbox)
-            nprint('-' * self.columns)
-            nprint('| Message: '); nprint(operation); nprint(' ' * (self.columns-12-len(operation))); nprint('|')
-            nprint('-' * self.columns)
-            def pr3(line, stack, operation, popv):
-                nprint('|'); nprint(line); nprint('|');
-                if operation == 'Stack POP':
-                    nprint(popv)
-                    nprint(' ' * (self.columns-1-self.vi-len(popv)))
-                    nprint('|')
-                else:
-                    nprint(' ' * (self.columns-1-self.vi)); nprint('|')
-            pline1, pline2, pline3, pline4, pline5, pline6 = self.getBlock(repr(value))
-            for v in range(1,7):
-                pr3(eval('nline{}'.format(v)), stack, operation, eval('pline{}'.format(v)))
-            nprint('-' * self.columns)
-            nprint('*' * self.columns)
-            nprint('* Stack:  bottom >------> top'); nprint(' ' * (self.columns-30)); nprint('*')
-            nprint('*' * self.columns)
-
-            tempDi = {'L{}'.format(v):'>' for v in range(1,7)}
-            for i in range(length):
-                line1, line2, line3, line4, line5, line6 = self.getBlock(repr(stack[i]))
-                for j in range(1,7):
-                    tempDi['L{}'.format(j)] += eval('line{}'.format(j))
-            tail = ' ' * (self.columns-2-length*12) + '>'
-            for k in range(1, 7):
-                tempDi['L{}'.format(k)] += tail
-            for ll in range(1,7):
-                nprint(tempDi['L{}'.format(ll)])
-            nprint('*' * self.columns)
+            rows += ['|' + ' ' * (columns - 2) + '|'] * 6
+        elif operation == 'Stack POP':
+            block = self.getBlock(repr(value))
+            rows += ['|' + line + '|' + popv + ' ' * (columns - 1 - self.vi - len(popv)) + '|'
+                     for line, popv in zip(self.getMsgBox(self.getFirstLineMsg(operation, value)), block)]
+        else:
+            rows += ['|' + line + '|' + ' ' * (columns - 1 - self.vi) + '|'
+                     for line in self.getMsgBox(self.getFirstLineMsg(operation, value))]
+
+        # the window scrolls with the top of the stack
+        first = max(0, length - self.window)
+        title = '* Stack:  bottom >------> top'
+        if first:
+            title += '   depth {}, showing {}-{}'.format(length, first + 1, length)
+        rows += ['-' * columns,
+                 '*' * columns,
+                 title + ' ' * (columns - 1 - len(title)) + '*',
+                 '*' * columns]
+
+        labels = {}
+        blocks = [self.getLabel(x, labels) for x in stack[first:]]
+        self.labels = labels
+        tail = ' ' * (columns - 2 - len(blocks) * 12) + '>'
+        head = '<' if first else '>'
+        rows += [head + ''.join(block[i] for block in blocks) + tail for i in range(self.height + 2)]
+        rows.append('*' * columns)
+        return [row[:columns] for row in rows]
+
+    def render(self, rows):
+        out = [] if self.frame else ['\x1b[2J']
+        for i, row in enumerate(rows):
+            if i >= len(self.frame) or self.frame[i] != row:
+                out.append('\x1b[{};1H{}'.format(i + 1, row))
+        for i in range(len(rows), len(self.frame)):
+            out.append('\x1b[{};1H\x1b[2K'.format(i + 1))
+        out.append('\x1b[{};1H'.format(len(rows) + 1))
+        self.frame = rows
+        self.out.write(''.join(out))
+        self.out.flush()
+
+    def wait(self):
+        # Keep a steady step rate: rendering time is taken out of the delay.
+        now = time.time()
+        if self.due is None or self.due < now - self.sleep:
+            self.due = now
+        self.due += self.sleep
+        if self.due > now:
+            time.sleep(self.due - now)
+
+    def sprint(self, stack, operation, value):
+        self.render(self.getFrame(stack, operation, value))
+        self.wait()
+
+
+class TraceRecorder(object):
+    """Write the StackShow events of a parse to a compact binary trace.
+
+    Names, namespace URIs and prefixes are interned: the first use of a
+    string emits a definition record and later events refer to it by id.
+    """
+
+    MAGIC = b'XTSTRACE\x01'
+    DEFINE, PUSH, TEXT, POP, ADD = range(5)
+    OPS = {'Stack IN': PUSH, 'Stack top add text': TEXT,
+           'Stack POP': POP, 'Stack top add Element': ADD}
+
+    def __init__(self, trace):
+        if trace is None:
+            raise ValueError("show='record' needs a trace file name or file object.")
+        if isstr(trace):
+            self.fileobj = open(trace, 'wb')
+            self.owned = True
+        else:
+            self.fileobj = trace
+            self.owned = False
+        self.strings = {None: 0}
+        self.write = self.fileobj.write
+        self.write(self.MAGIC)
+
+    def sid(self, s):
+        i = self.strings.get(s)
+        if i is None:
+            i = self.strings[s] = len(self.strings)
+            self.write(struct.pack('<BI', self.DEFINE, i) + self.pack(s))
+        return i
+
+    def pack(self, s):
+        s = s.encode('utf-8')
+        return struct.pack('<I', len(s)) + s
+
+    def qname(self, name):
+        if islst(name):
+            return struct.pack('<II', self.sid(name[0]), self.sid(name[1]))
+        return struct.pack('<II', 0, self.sid(name))
+
+    def sprint(self, stack, operation, value):
+        op = self.OPS[operation]
+        out = [struct.pack('<BI', op, len(stack))]
+        if op == self.PUSH:
+            out.append(self.qname(value._name))
+            out.append(struct.pack('<I', len(value._attrs)))
+            for k, v in value._attrs.items():
+                out.append(self.qname(k))
+                out.append(self.pack(v))
+            out.append(struct.pack('<I', len(value._prefixes)))
+            for uri, prefix in value._prefixes.items():
+                out.append(struct.pack('<II', self.sid(prefix), self.sid(uri)))
+        elif op == self.TEXT:
+            out.append(self.pack(value))
+        self.write(b''.join(out))
+
+    def close(self):
+        if self.owned:
+            self.fileobj.close()
         else:
-            print('Beyond screen width, cannot show it to you, please use a lower layer xml.')
+            self.fileobj.flush()
+
+
+class TraceReader(object):
+    """Iterate over a trace written by TraceRecorder.
+
+    Yields (operation, depth, value) triples, where value is a fresh Element
+    for pushes, the text for text events and None for pops.
+    """
+
+    def __init__(self, trace):
+        if isstr(trace):
+            with open(trace, 'rb') as fo:
+                self.data = fo.read()
+        else:
+            self.data = trace.read()
+        if not self.data.startswith(TraceRecorder.MAGIC):
+            raise ValueError('Not an xmltrampshow trace.')
+
+    def __iter__(self):
+        data = self.data
+        pos = len(TraceRecorder.MAGIC)
+        strings = [None]
+        names = dict((v, k) for k, v in TraceRecorder.OPS.items())
+        unpack = struct.unpack_from
+
+        def text(pos):
+            n, = unpack('<I', data, pos)
+            return data[pos + 4:pos + 4 + n].decode('utf-8'), pos + 4 + n
+
+        def qname(pos):
+            uri, local = unpack('<II', data, pos)
+            return (strings[uri], strings[local]), pos + 8
+
+        while pos < len(data):
+            op, depth = unpack('<BI', data, pos)
+            pos += 5
+            if op == TraceRecorder.DEFINE:
+                s, pos = text(pos)
+                strings.append(s)
+                continue
+            value = None
+            if op == TraceRecorder.PUSH:
+                name, pos = qname(pos)
+                attrs = {}
+                n, = unpack('<I', data, pos)
+                pos += 4
+                for _ in xrange(n):
+                    k, pos = qname(pos)
+                    attrs[k], pos = text(pos)
+                prefixes = {}
+                n, = unpack('<I', data, pos)
+                pos += 4
+                for _ in xrange(n):
+                    prefix, uri = unpack('<II', data, pos)
+                    prefixes[strings[prefix]] = strings[uri]
+                    pos += 8
+                value = Element(name, attrs, prefixes=prefixes)
+            elif op == TraceRecorder.TEXT:
+                value, pos = text(pos)
+            yield names[op], depth, value
+
+
+def replay(trace, sleep=3, fps=None):
+    """Animate a trace recorded with parse(..., show='record')."""
+    show = StackShow(sleep, fps)
+    stack = []
+    for operation, depth, value in TraceReader(trace):
+        if operation == 'Stack IN':
+            stack.append(value)
+        elif operation == 'Stack top add text':
+            stack[-1]._dir.append(value)
+        elif operation == 'Stack POP':
+            value = popped = stack.pop()
+        else:
+            value = popped
+            stack[-1]._dir.append(popped)
+        show.sprint(stack, operation, value)
+
+
+class Instrument(object):
+    """Counters, timings and hooks for the events of a parse.
+
+    Pass one to parse(..., instrument=...) (or Seeder/Parser/seed) and read
+    summary() afterwards. Attaching wraps the Seeder's own handler methods,
+    so a Seeder without an Instrument runs exactly as before.
+
+    hook(event, fn) registers fn(event, *args) to be called after each
+    event of that type, with the event's SAX arguments; 'endDocument'
+    hooks fire once when the parse ends.
+    """
+
+    events = ('startDocument', 'startPrefixMapping', 'endPrefixMapping', 'startElementNS',
+              'characters', 'endElementNS', 'endDocument')
+
+    def __init__(self, clock=time.perf_counter):
+        self.clock = clock
+        self.counts = dict((event, 0) for event in self.events + ('render',))
+        self.times = dict((event, 0.0) for event in self.events + ('render',))
+        self.peakDepth = 0
+        self.peakText = 0
+        self.text = 0
+        self.started = self.finished = None
+        self.hooks = {}
+
+    def hook(self, event, fn):
+        if event not in self.counts:
+            raise ValueError('Unknown event {}.'.format(repr(event)))
+        self.hooks.setdefault(event, []).append(fn)
+
+    def attach(self, seeder):
+        for event in self.events:
+            setattr(seeder, event, self.wrap(seeder, event, getattr(seeder, event)))
+        if seeder.show:
+            seeder.show.sprint = self.wrap(seeder, 'render', seeder.show.sprint)
+
+    def wrap(self, seeder, event, method):
+        clock, counts, times, hooks = self.clock, self.counts, self.times, self.hooks
+
+        def wrapper(*args):
+            start = clock()
+            if event == 'startDocument':
+                self.started = start
+            result = method(*args)
+            end = clock()
+            times[event] += end - start
+            counts[event] += 1
+            if event == 'characters':
+                # characters only buffers, the text is flushed by the next
+                # start or end tag
+                self.text += len(args[0])
+                if self.text > self.peakText:
+                    self.peakText = self.text
+            elif event == 'startElementNS':
+                self.text = 0
+                if len(seeder.stack) > self.peakDepth:
+                    self.peakDepth = len(seeder.stack)
+            elif event == 'endElementNS':
+                self.text = 0
+            elif event == 'endDocument':
+                self.finished = end
+            for fn in hooks.get(event, ()):
+                fn(event, *args)
+            return result
+        return wrapper
+
+    def summary(self):
+        """Return the collected numbers as a dict."""
+        return {'events': dict((event, {'count': self.counts[event], 'seconds': self.times[event]})
+                               for event in self.counts),
+                'seconds': (self.finished - self.started) if self.finished is not None else None,
+                'peakDepth': self.peakDepth,
+                'peakText': self.peakText}
+
+    def json(self, **kw):
+        import json
+        return json.dumps(self.summary(), **kw)
 
-        [print() for i in range(self.lines-22)]
-        time.sleep(self.sleep)
 
 class Seeder(EntityResolver, DTDHandler, ContentHandler, ErrorHandler):
-    def __init__(self):
+    def __init__(self, show='live', trace=None, fps=None, instrument=None, spill=None):
         self.stack = []
-        self.ch = ''
+        self.ch = []
+        self.size = 0
+        self.big = None
+        self.spill = spill
+        self.spillfile = None
+        if spill is not None:
+            if show is not None:
+                raise ValueError('Spilling text needs show=None.')
+            self.characters = self.spillCharacters
         self.prefixes = {}
-        self.show = StackShow(3)
+        self.scope = None
+        self.depth = self.elements = self.texts = self.attributes = self.fanout = 0
+        if show == 'live':
+            self.show = StackShow(3, fps)
+        elif show == 'record':
+            self.show = TraceRecorder(trace)
+        elif show is None:
+            self.show = None
+        else:
+            raise ValueError("show must be None, 'record' or 'live', not {}.".format(repr(show)))
+        if instrument is not None:
+            instrument.attach(self)
         ContentHandler.__init__(self)
 
     def startPrefixMapping(self, prefix, uri):
         if prefix not in self.prefixes:
             self.prefixes[prefix] = []
         self.prefixes[prefix].append(uri)
+        self.scope = None
 
     def endPrefixMapping(self, prefix):
         self.prefixes[prefix].pop()
         # szf: 5/15/5
         if len(self.prefixes[prefix]) == 0:
             del self.prefixes[prefix]
+        self.scope = None
+
+    def text(self):
+        """Return the text since the last tag, joined once, and reset it."""
+        if self.big is not None:
+            ch = self.big.finish()
+            self.big = None
+        elif not self.ch:
+            return None
+        else:
+            ch = self.ch[0] if len(self.ch) == 1 else ''.join(self.ch)
+        self.ch = []
+        self.size = 0
+        return ch
 
     def startElementNS(self, name, qname, attrs):
-        ch = self.ch
-        self.ch = ''
+        ch = self.text()
         if ch and not ch.isspace():
             self.stack[-1]._dir.append(ch)
+            self.texts += 1
+        elif not self.stack:
+            self.stamp = mutations
 
         attrs = dict(attrs)
-        newprefixes = {}
-        for k in self.prefixes.keys():
-            newprefixes[k] = self.prefixes[k][-1]
-
-        self.stack.append(Element(name, attrs, prefixes=newprefixes.copy()))
-        self.show.sprint(self.stack.copy(), 'Stack IN',  self.stack[-1])
+        if self.scope is None:
+            # the in-scope prefixes only change with prefix mappings
+            self.scope = {}
+            for k in self.prefixes.keys():
+                self.scope[k] = self.prefixes[k][-1]
+
+        self.stack.append(Element(name, attrs, prefixes=self.scope))
+        self.elements += 1
+        self.attributes += len(attrs)
+        if len(self.stack) > self.depth:
+            self.depth = len(self.stack)
+        if self.show:
+            self.show.sprint(self.stack, 'Stack IN',  self.stack[-1])
 
     def characters(self, ch):
         # This is called only by sax (never directly) and the string ch is
         # everytimes converted to text_type (unicode) by sax.
-        self.ch += ch
+        self.ch.append(ch)
+
+    def spillCharacters(self, ch):
+        # Text beyond spill characters goes on to a BigText instead.
+        if self.big is not None:
+            self.big.write(ch)
+            return
+        self.ch.append(ch)
+        self.size += len(ch)
+        if self.size > self.spill:
+            if self.spillfile is None:
+                self.spillfile = SpillFile()
+            self.big = BigText(self.spillfile)
+            for c in self.ch:
+                self.big.write(c)
+            self.ch = []
 
     def endElementNS(self, name, qname):
-        ch = self.ch
-        self.ch = ''
+        ch = self.text()
         if ch and not ch.isspace():
             self.stack[-1]._dir.append(ch)
-            self.show.sprint(self.stack.copy(), 'Stack top add text',  ch)
+            self.texts += 1
+            if self.show:
+                self.show.sprint(self.stack, 'Stack top add text',  ch)
+
+        element = self.stack.pop()
+        if len(element._dir) > self.fanout:
+            self.fanout = len(element._dir)
+        if self.show:
+            self.show.sprint(self.stack, 'Stack POP', element)
+        if self.stack:
+            self.stack[-1]._dir.append(element)
+            if self.show:
+                self.show.sprint(self.stack, 'Stack top add Element', element)
+        else:
+            self.result = element
+            # Only valid if nothing was mutated while parsing.
+            element._stats = (self.stamp, {'depth': self.depth, 'elements': self.elements,
+                                           'texts': self.texts, 'attributes': self.attributes,
+                                           'fanout': self.fanout})
+
+    def endDocument(self):
+        if isinstance(self.show, TraceRecorder):
+            self.show.close()
+
+
+class IterSeeder(Seeder):
+    """Seeder that collects finished elements matching tag and depth."""
+
+    def __init__(self, tag=None, depth=None):
+        Seeder.__init__(self, None)
+        self.tag = tag
+        self.level = depth
+        self.done = []
+
+    def endElementNS(self, name, qname):
+        level = len(self.stack) - 1
+        Seeder.endElementNS(self, name, qname)
+        if self.level is not None and level != self.level:
+            return
+        element = self.stack[-1]._dir[-1] if self.stack else self.result
+        if self.tag is None or element._name == self.tag:
+            self.done.append(element)
+            if self.stack:
+                # Drop it from its parent so that finished records don't pile
+                # up. The parent is still being built, so this is no edit that
+                # other trees' caches need to hear about, as del would be.
+                parent = self.stack[-1]
+                del parent._dir[-1]
+                setindex(parent, None)
+                self.stamp = None  # the counts below the root are off now
+
+
+class ColumnSeeder(Seeder):
+    """Seeder that fills a ColumnStore instead of building Elements."""
+
+    def __init__(self):
+        Seeder.__init__(self, None)
+        self.store = ColumnStore()
+        self.lasts = []
+        self.content, self.values = [], []
+        self.contentsize = self.valuesize = 0
+        self.nameids, self.scopeids = {}, {}
+        self.scopeid = None
+
+    def nameid(self, name):
+        nid = self.nameids.get(name)
+        if nid is None:
+            store = self.store
+            nid = self.nameids[name] = store.nameids[interned(name)] = len(store.nametable)
+            store.nametable.append(interned(name))
+        return nid
+
+    def node(self, nid, scope, start, end):
+        # append a node as the last child of the open element
+        store = self.store
+        n = len(store.names)
+        parent = self.stack[-1] if self.stack else -1
+        store.names.append(nid)
+        store.scopes.append(scope)
+        store.parents.append(parent)
+        store.firsts.append(-1)
+        store.nexts.append(-1)
+        store.afters.append(n + 1)
+        store.starts.append(start)
+        store.ends.append(end)
+        store.attrstarts.append(len(store.attrnames))
+        if self.lasts:
+            if self.lasts[-1] == -1:
+                store.firsts[parent] = n
+            else:
+                store.nexts[self.lasts[-1]] = n
+            self.lasts[-1] = n
+        return n
+
+    def addText(self):
+        ch = self.text()
+        if ch and not ch.isspace():
+            self.content.append(ch)
+            self.node(ColumnStore.TEXT, 0, self.contentsize, self.contentsize + len(ch))
+            self.contentsize += len(ch)
+
+    def startElementNS(self, name, qname, attrs):
+        self.addText()
+        if self.scope is None:
+            self.scope = {}
+            for k in self.prefixes.keys():
+                self.scope[k] = self.prefixes[k][-1]
+            key = tuple(self.scope.items())
+            if key not in self.scopeids:
+                self.scopeids[key] = len(self.store.scopetable)
+                self.store.scopetable.append(self.scope)
+            self.scopeid = self.scopeids[key]
+
+        n = self.node(self.nameid(name), self.scopeid, self.contentsize, 0)
+        store = self.store
+        for k, v in attrs.items():
+            store.attrnames.append(self.nameid(k))
+            store.attroffsets.append(self.valuesize)
+            self.values.append(v)
+            self.valuesize += len(v)
+        self.stack.append(n)
+        self.lasts.append(-1)
+
+    def endElementNS(self, name, qname):
+        self.addText()
+        store = self.store
+        n = self.stack.pop()
+        self.lasts.pop()
+        store.ends[n] = self.contentsize
+        store.afters[n] = len(store.names)
+        if not self.stack:
+            store.attrstarts.append(len(store.attrnames))
+            store.attroffsets.append(self.valuesize)
+            store.content = ''.join(self.content)
+            store.values = ''.join(self.values)
+            self.content, self.values = [], []
+            self.result = store
+
+
+class Parser(object):
+    """Push parser: feed() the document in chunks, close() returns the root.
+
+    Text and byte chunks are both accepted and may split the document
+    anywhere, including in the middle of a tag or a multi-byte character.
+    """
+
+    def __init__(self, show=None, trace=None, seeder=None, fps=None, instrument=None, spill=None):
+        self.seeder = seeder or Seeder(show, trace, fps, instrument, spill)
+        from xml.sax import make_parser
+        self.parser = make_parser()
+        self.parser.setFeature(feature_namespaces, 1)
+        self.parser.setContentHandler(self.seeder)
+
+    def feed(self, data):
+        try:
+            self.parser.feed(data)
+        except BaseException:
+            self.closeTrace()
+            raise
+
+    def close(self):
+        try:
+            self.parser.close()
+        except BaseException:
+            self.closeTrace()
+            raise
+        return self.seeder.result
+
+    def closeTrace(self):
+        # endDocument never comes for a failed parse, close the trace here
+        if isinstance(self.seeder.show, TraceRecorder):
+            self.seeder.show.close()
+
+
+class ExpatBuilder(object):
+    """Build the same Element trees as Seeder straight from pyexpat.
+
+    This skips the SAX reader layers: names are split once per distinct
+    raw name, attributes arrive as a flat list, the prefix map of a
+    namespace scope is built once rather than for every element, and text
+    is collected in a list and joined once. feed() and close() work as for
+    Parser.
+    """
+
+    def __init__(self, show=None, trace=None, fps=None):
+        self.stack = []
+        self.ch = []
+        self.prefixes = {}
+        self.scope = None
+        self.names = {}
+        if show == 'live':
+            self.show = StackShow(3, fps)
+        elif show == 'record':
+            self.show = TraceRecorder(trace)
+        elif show is None:
+            self.show = None
+        else:
+            raise ValueError("show must be None, 'record' or 'live', not {}.".format(repr(show)))
+
+        parser = self.parser = expat.ParserCreate(None, ' ')
+        parser.buffer_text = True
+        parser.ordered_attributes = True
+        parser.StartElementHandler = self.start
+        parser.EndElementHandler = self.end
+        parser.CharacterDataHandler = self.ch.append
+        parser.StartNamespaceDeclHandler = self.startPrefixMapping
+        parser.EndNamespaceDeclHandler = self.endPrefixMapping
+        # as the SAX reader does: skip external entities
+        parser.ExternalEntityRefHandler = lambda context, base, sysid, pubid: 1
+        parser.SetParamEntityParsing(expat.XML_PARAM_ENTITY_PARSING_UNLESS_STANDALONE)
+
+    def name(self, raw):
+        # pyexpat gives 'uri local' for names in a namespace
+        parts = raw.split(' ')
+        name = self.names[raw] = interned((parts[0], parts[1])) if len(parts) == 2 else raw
+        return name
+
+    def startPrefixMapping(self, prefix, uri):
+        if prefix not in self.prefixes:
+            self.prefixes[prefix] = []
+        self.prefixes[prefix].append(uri)
+        self.scope = None
+
+    def endPrefixMapping(self, prefix):
+        self.prefixes[prefix].pop()
+        if len(self.prefixes[prefix]) == 0:
+            del self.prefixes[prefix]
+        self.scope = None
+
+    def start(self, name, attrs):
+        ch = self.ch
+        if ch:
+            text = ''.join(ch)
+            del ch[:]
+            if not text.isspace():
+                self.stack[-1]._dir.append(text)
+
+        names = self.names
+        d = {}
+        for i in xrange(0, len(attrs), 2):
+            k = names.get(attrs[i]) or self.name(attrs[i])
+            d[k] = attrs[i + 1]
+        if self.scope is None:
+            self.scope = prefixmap(dict((k, v[-1]) for k, v in self.prefixes.items()))
+        element = Element._make(names.get(name) or self.name(name), d, [],
+                                self.scope[0], self.scope[1])
+        self.stack.append(element)
+        if self.show:
+            self.show.sprint(self.stack, 'Stack IN', element)
+
+    def end(self, name):
+        ch = self.ch
+        if ch:
+            text = ''.join(ch)
+            del ch[:]
+            if not text.isspace():
+                self.stack[-1]._dir.append(text)
+                if self.show:
+                    self.show.sprint(self.stack, 'Stack top add text', text)
 
         element = self.stack.pop()
-        self.show.sprint(self.stack.copy(), 'Stack POP', element)
+        if self.show:
+            self.show.sprint(self.stack, 'Stack POP', element)
         if self.stack:
             self.stack[-1]._dir.append(element)
-            self.show.sprint(self.stack.copy(), 'Stack top add Element', element)
+            if self.show:
+                self.show.sprint(self.stack, 'Stack top add Element', element)
         else:
             self.result = element
 
+    def feed(self, data):
+        try:
+            self.parser.Parse(data, False)
+        except BaseException:
+            self.closeTrace()
+            raise
+
+    def close(self):
+        try:
+            self.parser.Parse(b'', True)
+        finally:
+            self.closeTrace()
+        return self.result
+
+    def closeTrace(self):
+        if isinstance(self.show, TraceRecorder):
+            self.show.close()
+
+
+class LazyDocument(object):
+    """Offset index of an XML file, materialising elements on demand.
+
+    One expat pass over the mapped file records, for every element in
+    document order, its byte range, name, namespace scope and where its
+    subtree ends; no Elements or text are built. root is a LazyElement
+    whose attributes and children are parsed from the file the first time
+    they are used, one element at a time: the element's own bytes are
+    parsed with a placeholder for every child element, and the children
+    become unloaded LazyElements in turn.
+
+    At most cachesize loaded elements are kept, least recently used ones
+    are unloaded again. Elements that were changed are pinned instead.
+    Files must be in an ASCII compatible encoding (UTF-8, Latin-1, ...)
+    and may not define entities in an internal DTD subset.
+    """
 
-def seed(fileobj):
-    input('Please maximize your terminal window for this show.')
-    seeder = Seeder()
-    parser = make_parser()
-    parser.setFeature(feature_namespaces, 1)
-    parser.setContentHandler(seeder)
-    parser.parse(fileobj)
-    return seeder.result
+    # the start tag of a leaf, to tell <a/> from <a></a>
+    tag = re.compile(rb'''<[^\s/>]+(?:\s+[^\s=/>]+\s*=\s*(?:"[^"]*"|'[^']*'))*\s*(/?)>''')
+
+    def __init__(self, path, cachesize=1024):
+        self.path = path
+        self.cachesize = cachesize
+        self.encoding = None
+        self.starts, self.ends = array('Q'), array('Q')
+        self.names, self.scopes, self.after = array('I'), array('I'), array('I')
+        self.nametable, self.scopetable = [], []
+        self.loaded = OrderedDict()
+        self.pinned = {}
+        self.proxies = weakref.WeakValueDictionary()
+        with open(path, 'rb') as fo:
+            self.mm = mmap.mmap(fo.fileno(), 0, access=mmap.ACCESS_READ)
+        self.scan()
+        self.root = self.proxy(0)
+
+    def scan(self):
+        mm, starts, ends, names, scopes, after = (self.mm, self.starts, self.ends, self.names,
+                                                  self.scopes, self.after)
+        nameids, scopeids = {}, {}
+        prefixes = {}
+        stack = []
+        scope, leaf = None, False
+        parser = expat.ParserCreate(None, ' ')
+
+        def xmldecl(version, encoding, standalone):
+            self.encoding = encoding
+
+        def startPrefixMapping(prefix, uri):
+            nonlocal scope
+            prefixes.setdefault(prefix, []).append(uri)
+            scope = None
+
+        def endPrefixMapping(prefix):
+            nonlocal scope
+            prefixes[prefix].pop()
+            if not prefixes[prefix]:
+                del prefixes[prefix]
+            scope = None
+
+        def start(name, attrs):
+            nonlocal scope, leaf
+            if scope is None:
+                key = tuple((k, v[-1]) for k, v in prefixes.items())
+                if key not in scopeids:
+                    scopeids[key] = len(self.scopetable)
+                    self.scopetable.append(dict(key))
+                scope = scopeids[key]
+            if name not in nameids:
+                parts = name.split(' ')
+                nameids[name] = len(self.nametable)
+                self.nametable.append(interned((parts[0], parts[1])) if len(parts) == 2 else name)
+            stack.append(len(starts))
+            starts.append(parser.CurrentByteIndex)
+            ends.append(0)
+            names.append(nameids[name])
+            scopes.append(scope)
+            after.append(0)
+            leaf = True
+
+        def end(name):
+            nonlocal leaf
+            k = stack.pop()
+            i = parser.CurrentByteIndex
+            if leaf and mm[i - 2:i] == b'/>' and self.tag.match(mm, starts[k]).group(1):
+                ends[k] = i  # <a/>, expat is already past the tag
+            else:
+                ends[k] = mm.find(b'>', i) + 1
+            after[k] = len(starts)
+            leaf = False
+
+        parser.XmlDeclHandler = xmldecl
+        parser.StartNamespaceDeclHandler = startPrefixMapping
+        parser.EndNamespaceDeclHandler = endPrefixMapping
+        parser.StartElementHandler = start
+        parser.EndElementHandler = end
+        parser.ordered_attributes = True
+        parser.ExternalEntityRefHandler = lambda context, base, sysid, pubid: 1
+        parser.SetParamEntityParsing(expat.XML_PARAM_ENTITY_PARSING_UNLESS_STANDALONE)
+        for i in xrange(0, len(mm), 1 << 20):
+            parser.Parse(mm[i:i + (1 << 20)], False)
+        parser.Parse(b'', True)
+
+    def children(self, k):
+        c, end = k + 1, self.after[k]
+        while c < end:
+            yield c
+            c = self.after[c]
+
+    def proxy(self, k):
+        element = self.proxies.get(k)
+        if element is None:
+            element = LazyElement.__new__(LazyElement)
+            prefixes, dNS = prefixmap(self.scopetable[self.scopes[k]])
+            setslots(element, self.nametable[self.names[k]], None, None, prefixes, dNS)
+            element._doc = self
+            element._id = k
+            self.proxies[k] = element
+        return element
+
+    def load(self, element):
+        """Parse the attributes and children of element from the file."""
+        mm, k = self.mm, element._id
+        scope = self.scopetable[self.scopes[k]]
+        # the children are cut out, and a wrapper declares the namespaces
+        wrapper = '<?xml version="1.0" encoding="{}"?><_'.format(self.encoding or 'utf-8')
+        for prefix in scope:
+            wrapper += ' xmlns{}="{}"'.format(':' + prefix if prefix else '',
+                                              quote(scope[prefix] or '', False))
+        parts = [(wrapper + '>').encode(self.encoding or 'utf-8')]
+        pos = self.starts[k]
+        children = []
+        for c in self.children(k):
+            parts.append(mm[pos:self.starts[c]])
+            parts.append(b'<_/>')
+            pos = self.ends[c]
+            children.append(c)
+        parts.append(mm[pos:self.ends[k]])
+        parts.append(b'</_>')
+        builder = ExpatBuilder()
+        builder.feed(b''.join(parts))
+        parsed = builder.close()._dir[0]
+        children = iter(children)
+        dir = [self.proxy(next(children)) if isinstance(x, Element) else x for x in parsed._dir]
+        setattrs(element, parsed._attrs)
+        setdir(element, dir)
+        self.loaded[k] = element
+        while len(self.loaded) > max(self.cachesize, 1):
+            self.unload(self.loaded.popitem(False)[1])
+        return dir
+
+    def unload(self, element):
+        setattrs(element, None)
+        setdir(element, None)
+        setindex(element, None)
+        setindexed(element, 0)
+        settext(element, None)
+        setstats(element, None)
+        sethash(element, None)
+
+    def touch(self, element):
+        if element._id in self.loaded:
+            self.loaded.move_to_end(element._id)
+
+    def pin(self, element):
+        self.loaded.pop(element._id, None)
+        self.pinned[element._id] = element
+
+
+getdir, getattrs = Element._dir.__get__, Element._attrs.__get__
+
+
+class LazyElement(Element):
+    """An Element of a LazyDocument, loaded when its _dir or _attrs is used."""
+
+    __slots__ = ('_doc', '_id', '__weakref__')
+
+    @property
+    def _dir(self):
+        children = getdir(self)
+        if children is None:
+            return self._doc.load(self)
+        self._doc.touch(self)
+        return children
+
+    @_dir.setter
+    def _dir(self, children):
+        if getdir(self) is None:
+            self._doc.load(self)
+        setdir(self, children)
+        self._doc.pin(self)
+
+    @property
+    def _attrs(self):
+        attrs = getattrs(self)
+        if attrs is None:
+            self._doc.load(self)
+            return getattrs(self)
+        self._doc.touch(self)
+        return attrs
+
+    @_attrs.setter
+    def _attrs(self, attrs):
+        if getattrs(self) is None:
+            self._doc.load(self)
+        setattrs(self, attrs)
+        self._doc.pin(self)
+
+    def _changed(self, appended=False):
+        # edits only live in memory, so this element may not be unloaded
+        if getdir(self) is None:
+            self._doc.load(self)
+        self._doc.pin(self)
+        Element._changed(self, appended)
+
+
+class ColumnStore(object):
+    """A parsed document held in flat parallel arrays rather than Elements.
+
+    Nodes are numbered in document order from the root, 0. Node n is an
+    element, or a text if names[n] is TEXT:
+
+      names[n]           id of its name in nametable
+      parents[n], firsts[n], nexts[n]
+                         its parent, first child and next sibling, -1 if none
+      afters[n]          the first node after its subtree
+      scopes[n]          its namespace scope in scopetable (prefix -> uri)
+      starts[n], ends[n] where its text is in content: a text node's own,
+                         all the text below an element for an element
+      attrstarts[n] to attrstarts[n + 1]
+                         its attributes: names (ids) in attrnames, and values
+                         in values between consecutive attroffsets
+
+    The bulk methods (find, count, texts, attributes) scan the arrays
+    without making an object per node. view(n) gives read-only Element
+    views for the usual API; root is the view of the root element.
+    """
+
+    TEXT = 0xFFFFFFFF
+
+    def __init__(self):
+        self.names, self.scopes = array('I'), array('I')
+        self.parents, self.firsts, self.nexts = array('i'), array('i'), array('i')
+        self.afters = array('I')
+        self.starts, self.ends = array('Q'), array('Q')
+        self.attrstarts, self.attrnames, self.attroffsets = array('I'), array('I'), array('Q')
+        self.nametable, self.scopetable = [], []
+        self.nameids = {}
+        self.content = self.values = ''
+
+    @property
+    def root(self):
+        return self.view(0)
+
+    def nameid(self, name):
+        """Return the id of name ('movie' or (uri, 'movie')), None if unused."""
+        return self.nameids.get(interned(name))
+
+    def find(self, name):
+        """Yield the elements named name, in document order."""
+        nid = self.nameid(name)
+        if nid is None:
+            return
+        for n, x in enumerate(self.names):
+            if x == nid:
+                yield n
+
+    def count(self, name):
+        nid = self.nameid(name)
+        return 0 if nid is None else self.names.count(nid)
+
+    def children(self, n):
+        c = self.firsts[n]
+        while c != -1:
+            yield c
+            c = self.nexts[c]
+
+    def text(self, n):
+        """Return all the text below node n, as ''.join(itertext()) would."""
+        return self.content[self.starts[n]:self.ends[n]]
+
+    def texts(self, name, normalize=False):
+        """Yield all the text below each element named name.
+
+        As with text(), the text nodes are run together with no separator,
+        and whitespace is kept as it is: a <movie> of movies.xml gives
+        'War, ThrillerDVD2003PG10Talk about...'. With normalize, runs of
+        whitespace become one space and the ends are stripped, which gives
+        what str() of the element gives.
+        """
+        content, starts, ends = self.content, self.starts, self.ends
+        for n in self.find(name):
+            text = content[starts[n]:ends[n]]
+            yield ' '.join(text.split()) if normalize else text
+
+    def attribute(self, n, name, default=None):
+        name = interned(name)
+        for i in xrange(self.attrstarts[n], self.attrstarts[n + 1]):
+            if self.nametable[self.attrnames[i]] == name:
+                return self.values[self.attroffsets[i]:self.attroffsets[i + 1]]
+        return default
+
+    def attributes(self, name, attr, default=None):
+        """Yield attribute attr (or default) of each element named name."""
+        for n in self.find(name):
+            yield self.attribute(n, attr, default)
+
+    def view(self, n):
+        """Return node n as a ColumnElement, or as a string for a text."""
+        if self.names[n] == self.TEXT:
+            return self.content[self.starts[n]:self.ends[n]]
+        element = ColumnElement.__new__(ColumnElement)
+        prefixes, dNS = prefixmap(self.scopetable[self.scopes[n]])
+        setslots(element, self.nametable[self.names[n]], None, None, prefixes, dNS)
+        element._store = self
+        element._node = n
+        return element
+
+
+class ColumnElement(Element):
+    """Read-only Element view of an element of a ColumnStore."""
+
+    __slots__ = ('_store', '_node')
+
+    @property
+    def _dir(self):
+        children = getdir(self)
+        if children is None:
+            store = self._store
+            children = tuple(store.view(c) for c in store.children(self._node))
+            setdir(self, children)
+        return children
+
+    @property
+    def _attrs(self):
+        store, n = self._store, self._node
+        offsets = store.attroffsets
+        return dict((store.nametable[store.attrnames[i]], store.values[offsets[i]:offsets[i + 1]])
+                    for i in xrange(store.attrstarts[n], store.attrstarts[n + 1]))
+
+    def _changed(self, appended=False):
+        raise TypeError('ColumnStore views are read-only.')
+
+
+class ConnectionPool(object):
+    """Keep-alive HTTP and HTTPS connections for parse_url, by host.
+
+    At most size idle connections are kept per host; more can be in use at
+    once, but those are closed rather than kept when they come back.
+    created counts the connections opened, reused those handed out again.
+    """
+
+    def __init__(self, size=4, timeout=30):
+        self.size = size
+        self.timeout = timeout
+        self.idle = {}
+        import threading
+        self.lock = threading.Lock()
+        self.created = self.reused = 0
+
+    def get(self, scheme, host):
+        from http import client as http_client
+        with self.lock:
+            idle = self.idle.get((scheme, host))
+            if idle:
+                self.reused += 1
+                return idle.pop(), True
+            self.created += 1
+        if scheme == 'https':
+            return http_client.HTTPSConnection(host, timeout=self.timeout), False
+        return http_client.HTTPConnection(host, timeout=self.timeout), False
+
+    def put(self, scheme, host, connection):
+        with self.lock:
+            idle = self.idle.setdefault((scheme, host), [])
+            if len(idle) < self.size:
+                idle.append(connection)
+                return
+        connection.close()
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, {}
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+
+connections = None
+
+
+class TreeCache(object):
+    """On-disk cache of parsed trees, keyed by a hash of the document.
+
+    Trees are stored in a compact binary format: a table of interned
+    strings, a table of names, a table of namespace scopes and flat arrays
+    of nodes and attributes in document order. Loading maps the file and
+    rebuilds the Elements straight from those arrays, without SAX. Files
+    are evicted least recently used first once the cache directory grows
+    beyond maxsize bytes.
+    """
 
+    MAGIC = b'XTSCACHE'
+    HEADER = struct.Struct('<8sB3x8I')
+    NONE = 0xFFFFFFFF
+    TEXT = 0x80000000
 
-def parse(text):
+    def __init__(self, directory, maxsize=1 << 30):
+        self.directory = directory
+        self.maxsize = maxsize
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def key(self, text):
+        if isinstance(text, text_type):
+            text = b'u' + text.encode('utf-8', 'surrogatepass')
+        else:
+            text = b'b' + text
+        import hashlib
+        return hashlib.sha1(text).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.xtc')
+
+    def get(self, key):
+        """Return the tree stored under key, or None.
+
+        A file that can't be read back (truncated, corrupt, from another
+        version) counts as a miss and is deleted.
+        """
+        path = self.path(key)
+        try:
+            fo = open(path, 'rb')
+        except (IOError, OSError):
+            return None
+        # Nothing loaded can form a cycle, so spare the collector from
+        # walking the growing tree over and over.
+        enabled = gc.isenabled()
+        gc.disable()
+        try:
+            with fo:
+                mm = mmap.mmap(fo.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    element = self.load(mm)
+                finally:
+                    mm.close()
+        except Exception:
+            element = None
+        finally:
+            if enabled:
+                gc.enable()
+        try:
+            if element is None:
+                os.remove(path)
+            else:
+                os.utime(path, None)
+        except OSError:
+            pass
+        return element
+
+    def load(self, mm):
+        if len(mm) < self.HEADER.size:
+            return None
+        magic, order, nstrings, nchars, nbytes, nnames, nmaps, nentries, nnodes, nattrs = \
+            self.HEADER.unpack_from(mm)
+        if magic != self.MAGIC or order != (sys.byteorder == 'little'):
+            return None
+        size = (self.HEADER.size + 4 * (nstrings + 1) + ((nbytes + 3) & ~3) +
+                4 * (2 * nnames + 3 * nmaps + 2 * nentries + 4 * nnodes + 2 * nattrs))
+        if size != len(mm):
+            return None
+
+        view = memoryview(mm)
+        pos = [self.HEADER.size]
+
+        def ints(n):
+            a = view[pos[0]:pos[0] + 4 * n].cast('I').tolist()
+            pos[0] += 4 * n
+            return a
+
+        try:
+            offsets = ints(nstrings + 1)
+            chars = bytes(view[pos[0]:pos[0] + nbytes]).decode('utf-8', 'surrogatepass')
+            pos[0] += (nbytes + 3) & ~3
+            names = ints(2 * nnames)
+            maps = ints(3 * nmaps)
+            entries = ints(2 * nentries)
+            nodes = ints(4 * nnodes)
+            attrs = ints(2 * nattrs)
+        finally:
+            view.release()
+        if len(chars) != nchars:
+            return None
+
+        NONE, TEXT = self.NONE, self.TEXT
+        strings = [chars[offsets[i]:offsets[i + 1]] for i in xrange(nstrings)]
+        names = [strings[names[i + 1]] if names[i] == NONE else
+                 interned((strings[names[i]], strings[names[i + 1]]))
+                 for i in xrange(0, len(names), 2)]
+        # the None uri (xmlns="") and the None prefix (a default namespace)
+        strings.append(None)
+        entries = [len(strings) - 1 if i == NONE else i for i in entries]
+        scopes = []
+        for i in xrange(0, len(maps), 3):
+            start, count, dNS = maps[i:i + 3]
+            scopes.append((MappingProxyType(dict(
+                (strings[entries[j]], strings[entries[j + 1]])
+                for j in xrange(2 * start, 2 * (start + count), 2))),
+                strings[dNS] if dNS != NONE else None))
+
+        root = None
+        stack = []  # [children list, children still to come]
+        attrs = iter(attrs)
+        make = Element._make
+        it = iter(nodes)
+        for ref, n, scope, nattr in zip(it, it, it, it):
+            if ref & TEXT:
+                x = strings[ref & ~TEXT]
+                children = None
+            else:
+                d = {}
+                for _ in xrange(nattr):
+                    k = names[next(attrs)]
+                    d[k] = strings[next(attrs)]
+                prefixes, dNS = scopes[scope]
+                children = []
+                x = make(names[ref], d, children, prefixes, dNS)
+            if stack:
+                top = stack[-1]
+                top[0].append(x)
+                top[1] -= 1
+                if n:
+                    stack.append([children, n])
+                else:
+                    while stack and not stack[-1][1]:
+                        stack.pop()
+            else:
+                root = x
+                if n:
+                    stack.append([children, n])
+        return root
+
+    def dump(self, element, fileobj):
+        strings = {}
+        stringlist = []
+        names = {}
+        namelist = array('I')
+        scopes = {}
+        maplist = array('I')
+        entries = array('I')
+        nodes = array('I')
+        attrs = array('I')
+        NONE = self.NONE
+
+        def sid(s):
+            if s is None:
+                return NONE
+            i = strings.get(s)
+            if i is None:
+                i = strings[s] = len(stringlist)
+                stringlist.append(s)
+            return i
+
+        def nid(name):
+            i = names.get(name)
+            if i is None:
+                i = names[name] = len(names)
+                if islst(name):
+                    namelist.extend((sid(name[0]), sid(name[1])))
+                else:
+                    namelist.extend((NONE, sid(name)))
+            return i
+
+        stack = [element]
+        while stack:
+            x = stack.pop()
+            if not isinstance(x, Element):
+                nodes.extend((self.TEXT | sid(x if isstr(x) else text_type(x)), 0, 0, 0))
+                continue
+            key = (tuple(x._prefixes.items()), x._dNS)
+            scope = scopes.get(key)
+            if scope is None:
+                scope = scopes[key] = len(scopes)
+                maplist.extend((len(entries) // 2, len(x._prefixes), sid(x._dNS)))
+                for uri, prefix in x._prefixes.items():
+                    entries.extend((sid(uri), sid(prefix)))
+            nodes.extend((nid(x._name), len(x._dir), scope, len(x._attrs)))
+            for k, v in x._attrs.items():
+                attrs.extend((nid(k), sid(v)))
+            stack.extend(reversed(x._dir))
+
+        offsets = array('I', [0])
+        total = 0
+        for s in stringlist:
+            total += len(s)
+            offsets.append(total)
+        blob = ''.join(stringlist).encode('utf-8', 'surrogatepass')
+        fileobj.write(self.HEADER.pack(self.MAGIC, sys.byteorder == 'little', len(stringlist), total,
+                                       len(blob), len(names), len(scopes), len(entries) // 2,
+                                       len(nodes) // 4, len(attrs) // 2))
+        fileobj.write(offsets.tobytes())
+        fileobj.write(blob + b'\0' * (-len(blob) % 4))
+        for a in (namelist, maplist, entries, nodes, attrs):
+            fileobj.write(a.tobytes())
+
+    def put(self, key, element):
+        """Store element under key and evict old entries if needed."""
+        path = self.path(key)
+        tmp = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp, 'wb') as fo:
+            self.dump(element, fo)
+        os.replace(tmp, path)
+        self.evict()
+
+    def evict(self):
+        files = []
+        total = 0
+        for name in os.listdir(self.directory):
+            if name.endswith('.xtc'):
+                path = os.path.join(self.directory, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                files.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+        files.sort()
+        for mtime, size, path in files:
+            if total <= self.maxsize:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+
+# Set to a TreeCache to have headless parse() calls look documents up there.
+cache = None
+
+
+def seed(fileobj, show='live', trace=None, fps=None, instrument=None, backend='sax', spill=None):
+    """Parse fileobj to tree of Element.
+
+    show: 'live' animates the parser stack in the terminal, 'record' writes
+          the same events to the trace file (see replay), None parses
+          headless at full speed.
+    fps: steps per second of the 'live' show, one step every 3 seconds if None
+    instrument: an Instrument to collect event counts and timings
+    backend: 'sax' (xml.sax with Seeder) or 'expat' (ExpatBuilder, faster)
+    spill: headless only, text nodes longer than this many characters are
+           kept in temporary files as BigText rather than in memory
+    """
+    if backend not in ('sax', 'expat'):
+        raise ValueError("backend must be 'sax' or 'expat', not {}.".format(repr(backend)))
+    if backend == 'expat' and instrument is not None:
+        raise ValueError('Instruments need the sax backend.')
+    if backend == 'expat' and spill is not None:
+        raise ValueError('Spilling text needs the sax backend.')
+    if show is not None and spill is not None:
+        raise ValueError('Spilling text needs show=None.')
+    if show == 'live' and sys.stdin is not None and sys.stdin.isatty():
+        input('Please maximize your terminal window for this show.')
+    if backend == 'expat':
+        builder = ExpatBuilder(show, trace, fps)
+        while True:
+            data = fileobj.read(65536)
+            if not data:
+                break
+            builder.feed(data)
+        return builder.close()
+    parser = Parser(show, trace, fps=fps, instrument=instrument, spill=spill)
+    try:
+        parser.parser.parse(fileobj)
+    except BaseException:
+        parser.closeTrace()
+        raise
+    return parser.seeder.result
+
+
+def parse(text, show='live', trace=None, fps=None, instrument=None, backend='sax', spill=None):
     """Parse XML to tree of Element.
 
     text: XML in unicode or byte string
+    show: None, 'record' or 'live', see seed
+    trace: file name or binary file object the 'record' show writes to
+    backend: 'sax' or 'expat', see seed
+    spill: see seed
+
+    Headless parses go through the module's TreeCache if one is set.
+    """
+    if show is None and cache is not None and instrument is None and spill is None:
+        key = cache.key(text)
+        element = cache.get(key)
+        if element is None:
+            element = seed(StringIO(text) if isinstance(text, text_type) else BytesIO(text), None,
+                           backend=backend)
+            cache.put(key, element)
+        return element
+    return seed(StringIO(text) if isinstance(text, text_type) else BytesIO(text), show, trace, fps,
+                instrument, backend, spill)
+
+
+def iterparse(fileobj, tag=None, depth=None, bufsize=65536):
+    """Parse fileobj incrementally, yielding finished elements.
+
+    tag: only yield elements with this name, e.g. 'movie' or doc.record
+    depth: only yield elements at this depth (the root is at depth 0)
+
+    Each yielded Element is removed from its parent, so memory stays
+    proportional to the size of one record rather than of the document.
+    """
+    seeder = IterSeeder(tag, depth)
+    parser = Parser(seeder=seeder)
+    while True:
+        data = fileobj.read(bufsize)
+        if not data:
+            break
+        parser.feed(data)
+        for element in seeder.done:
+            yield element
+        del seeder.done[:]
+    parser.parser.close()
+    for element in seeder.done:
+        yield element
+
+
+async def aparse(reader, bufsize=65536):
+    """Parse XML arriving on an asyncio StreamReader without blocking the loop.
+
+    Chunks are fed to a Parser as soon as they are read, so many slow
+    streams can be parsed concurrently on one event loop.
+    """
+    parser = Parser()
+    while True:
+        data = await reader.read(bufsize)
+        if not data:
+            break
+        parser.feed(data)
+    return parser.close()
+
+
+def lazyparse(path, cachesize=1024):
+    """Index the XML file at path, returning its root as a LazyElement.
+
+    Only the elements that are used get parsed, see LazyDocument.
+    """
+    return LazyDocument(path, cachesize).root
+
+
+def parse_url(url, pool=None, bufsize=65536, redirects=5):
+    """Fetch url and parse it headless, returning the root Element.
+
+    The body is fed to the parser chunk by chunk as it arrives. http and
+    https go through pool (a module-wide ConnectionPool by default), so
+    requests to the same host reuse keep-alive connections; other schemes
+    are opened with urlopen. Up to redirects redirects are followed.
+    """
+    global connections
+    from http import client as http_client
+    from urllib.parse import urljoin, urlparse
+    from urllib.request import urlopen
+    if pool is None:
+        if connections is None:
+            connections = ConnectionPool()
+        pool = connections
+    parser = Parser()
+    while True:
+        parts = urlparse(url)
+        if parts.scheme not in ('http', 'https'):
+            with urlopen(url) as response:
+                while True:
+                    data = response.read(bufsize)
+                    if not data:
+                        break
+                    parser.feed(data)
+            return parser.close()
+
+        path = (parts.path or '/') + ('?' + parts.query if parts.query else '')
+        connection, reused = pool.get(parts.scheme, parts.netloc)
+        location = error = None
+        try:
+            try:
+                connection.request('GET', path)
+                response = connection.getresponse()
+            except (http_client.RemoteDisconnected, ConnectionError):
+                if not reused:
+                    raise
+                # the server dropped the idle connection, try once more
+                connection.close()
+                connection.request('GET', path)
+                response = connection.getresponse()
+            if response.status in (301, 302, 303, 307, 308) and redirects:
+                response.read()
+                location = urljoin(url, response.getheader('Location'))
+            elif response.status != 200:
+                response.read()
+                error = http_client.HTTPException('{} {} for {}'.format(response.status,
+                                                                        response.reason, url))
+            else:
+                while True:
+                    data = response.read1(bufsize)
+                    if not data:
+                        break
+                    parser.feed(data)
+                # read1() never marks a response with a length as done
+                response.read()
+                element = parser.close()
+        except BaseException:
+            # a half read response leaves the connection unusable
+            connection.close()
+            raise
+        if response.will_close:
+            connection.close()
+        else:
+            pool.put(parts.scheme, parts.netloc, connection)
+        if error is not None:
+            raise error
+        if location is None:
+            return element
+        url, redirects = location, redirects - 1
+
+
+def parseURL(url, pool):
+    """Parse url with parse_url, returning (url, element, error)."""
+    try:
+        return url, parse_url(url, pool), None
+    except Exception as e:
+        return url, None, '{}: {}'.format(type(e).__name__, e)
+
+
+def parse_urls(urls, concurrency=8, ordered=True):
+    """Fetch and parse many URLs on concurrency threads.
+
+    Yields (url, element, error) triples as parse_many does. The batch
+    shares a ConnectionPool keeping up to concurrency idle connections
+    per host, closed when the batch is done.
     """
-    return seed(StringIO(text) if isinstance(text, text_type) else BytesIO(text))
+    pool = ConnectionPool(concurrency)
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+    executor = ThreadPoolExecutor(concurrency)
+    try:
+        if ordered:
+            for result in executor.map(lambda url: parseURL(url, pool), urls):
+                yield result
+        else:
+            for future in as_completed([executor.submit(parseURL, url, pool) for url in urls]):
+                yield future.result()
+    finally:
+        executor.shutdown()
+        pool.close()
 
 
+def parse_columns(text):
+    """Parse XML headless into a ColumnStore, see there."""
+    parser = Parser(seeder=ColumnSeeder())
+    parser.feed(text)
+    return parser.close()
+
+
+def parseFile(path):
+    """Parse the file at path headless, returning (path, element, error)."""
+    try:
+        with open(path, 'rb') as fo:
+            return path, seed(fo, None), None
+    except Exception as e:
+        return path, None, '{}: {}'.format(type(e).__name__, e)
+
+
+def parse_many(paths, workers=None, ordered=True, chunksize=16):
+    """Parse many files headless on a pool of worker processes.
+
+    Yields (path, element, error) triples: in the order of paths if ordered,
+    otherwise as soon as each parse finishes. error is None on success, or
+    a 'Type: message' string for a file that failed; the rest of the batch
+    carries on either way. workers defaults to the number of CPUs; with
+    workers=1 the files are parsed in this process.
+    """
+    if workers == 1:
+        for path in paths:
+            yield parseFile(path)
+        return
+    import multiprocessing
+    pool = multiprocessing.Pool(workers)
+    try:
+        if ordered:
+            results = pool.imap(parseFile, paths, chunksize)
+        else:
+            results = pool.imap_unordered(parseFile, paths, chunksize)
+        for result in results:
+            yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()